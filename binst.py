@@ -2,29 +2,46 @@
 
 '''Push CE test S/W to devices.'''
 
-import ipaddress
+from contextlib import contextmanager
 import logging
+import os
 from pathlib import Path
 import shlex
-import shutil
-import socketserver
 import subprocess
 import sys
-from tempfile import TemporaryDirectory
+import time
 from time import monotonic as now
 
-import loadsdir
-import loadsfile
-import loadsutil
+# The loads* modules (and the HTTP server, SQLite, etc. they pull in) are
+# imported only where needed, so that e.g. --list-targets and argument errors
+# do not have to wait for them.
 
 
+logger = logging.getLogger('binst')
+
 USAGE = '''
     %(prog)s --list-targets
     %(prog)s [-t] <target> <destination> [opts...]
+    %(prog)s -t <target> -t <target> [-t ...] <destination> [opts...]
+    %(prog)s --calibrate <target> <destination> [--via <host>]
 '''
 
 DEFAULT_SSH = 'ssh'
 INSTALLIMAGE = '/sbin/installimage'
+SSH_PROFILE_PATH = Path.home() / '.config/binst/profile.json'
+HISTORY_DB_PATH = Path.home() / '.cache/binst/history.sqlite'
+CALIBRATE_SIZE = 16 * 1024 * 1024
+SHARED_RATE_DIR = Path('/tmp/binst-rate-limit')  # shared by all users
+
+# SSH (cipher, MAC) combinations to try with --calibrate. The AEAD ciphers
+# include their own integrity protection, and thus have no separate MAC.
+SSH_TRANSPORTS = [
+    ('chacha20-poly1305@openssh.com', None),
+    ('aes128-gcm@openssh.com', None),
+    ('aes256-gcm@openssh.com', None),
+    ('aes128-ctr', 'umac-64-etm@openssh.com'),
+    ('aes128-ctr', 'hmac-sha2-256-etm@openssh.com'),
+]
 
 TARGETS = {
     'asterix': {
@@ -177,7 +194,8 @@ TARGETS = {
 class BinstTarget:
     @classmethod
     def create(cls, name):
-        assert name in TARGETS
+        if name not in TARGETS:
+            raise ValueError('Unknown target: {}'.format(name))
         return cls(name=name, **TARGETS[name])
 
     def __init__(self, name, *, desc, subtarget=None, ssh=None, destpath=None,
@@ -195,12 +213,29 @@ class BinstTarget:
                 self.name + ' prefers --loads, but does not support it!')
 
     def support_loads(self):
+        import loadsfile
+
         return self.loadsname in loadsfile.Targets
 
     def find_image(self, objdir=None):
         '''Return path to image for this build target.'''
+        import loadsdir
+
         return loadsdir.find_pkg(self.name, objdir)
 
+    def partial_script(self):
+        '''Prepare shell commands to inspect a partially transferred image.
+
+        The script prints the size and SHA512 checksum of what an earlier
+        transfer left behind in "$destpath.tmp" (or nothing if there is none).
+        '''
+        assert self.destpath is not None
+        return '; '.join([
+            'destpath={}'.format(self.destpath),
+            '[ -f "$destpath.tmp" ] && wc -c <"$destpath.tmp" &&'
+            ' sha512sum <"$destpath.tmp" | cut -d" " -f1',
+        ])
+
     def is_remotesupport_compatible(self):
         # remotesupport user is limited to a shell where only a few commands
         # are allowed via sudo. This includes 'installimage' which is used to
@@ -209,23 +244,50 @@ class BinstTarget:
         # order to place the image at self.destpath.
         return self.destpath is None
 
-    def remote_script(self, allow_test_sw=False, sudo='', install_args=''):
+    def remote_script(self, allow_test_sw=False, sudo='', install_args='',
+                      image_url=None, checksum=None, offset=0, size=None):
         '''Prepare the shell commands to run over SSH on the remote device.
 
         The script returned from here may expect the target image to be
-        streamed into its stdin.
+        streamed into its stdin. If 'image_url' is given, the image is instead
+        fetched over HTTP from that URL (which may refer to shell variables).
+        A fetched image that is stored at self.destpath is verified against the
+        given SHA512 'checksum' before it is put in place. Images passed into
+        installimage are verified by installimage itself.
+
+        When streaming an image to self.destpath, 'offset' bytes may already
+        have been stored by a previous (interrupted) transfer, and the script
+        expects to receive only the remaining bytes. If the total image 'size'
+        is given, it is verified before the image is put in place.
         '''
         script = ['. /etc/profile']
         if allow_test_sw:
             script.append('touch /tmp/allow_test_software')
 
+        if image_url is not None:
+            script.append('image_url="{}"'.format(image_url))
+
         if self.destpath is None:  # pass image directly into installimage
-            script.append('{} {} -k /mnt/base/active/rk -f - {}'.format(
+            script.append('{}{} {} -k /mnt/base/active/rk -f - {}'.format(
+                '' if image_url is None else 'wget -q -O - "$image_url" | ',
                 sudo, INSTALLIMAGE, install_args))
-        else:  # store image at self.destpath
+        elif image_url is None:  # store image from stdin at self.destpath
+            script.extend([
+                'destpath={}'.format(self.destpath),
+                'cat - {}"$destpath.tmp"{} && mv "$destpath.tmp" "$destpath"'
+                .format(
+                    '>>' if offset else '>',
+                    '' if size is None else
+                    ' && [ $(wc -c <"$destpath.tmp") -eq {} ]'.format(size)),
+            ])
+        else:  # fetch, verify and store image at self.destpath
             script.extend([
                 'destpath={}'.format(self.destpath),
-                'cat - >"$destpath.tmp" && mv "$destpath.tmp" "$destpath"',
+                'wget -q -O "$destpath.tmp" "$image_url" || exit 1',
+                '[ "$(sha512sum <"$destpath.tmp" | cut -d" " -f1)" = {} ] || '
+                '{{ echo "Checksum mismatch in $destpath.tmp!" >&2; exit 1; }}'
+                .format(checksum),
+                'mv "$destpath.tmp" "$destpath"',
             ])
 
         if self.posthook is not None:
@@ -234,8 +296,56 @@ class BinstTarget:
         return '; '.join(script)
 
 
+def combined_remote_script(targets, sizes, allow_test_sw=False):
+    '''Prepare the shell commands for installing several targets in one go.
+
+    All 'targets' must store their image at a destpath. The script returned
+    from here expects the images to be streamed back-to-back into its stdin,
+    and uses the given image 'sizes' to tell them apart. Once all images are
+    in place, the targets' posthooks are run: First, the posthooks that refer
+    to their own $destpath (in the given target order), and then the remaining
+    posthooks (e.g. "/bin/mainrestart update"), each run only once.
+    '''
+    assert all(t.destpath is not None for t in targets)
+    assert len(targets) == len(sizes)
+    bs = 64 * 1024
+    script = [
+        '. /etc/profile',
+        # Read exactly $1 bytes from stdin, without consuming any more
+        'readn() {{ dd bs={0} count=$(($1 / {0})) iflag=fullblock 2>/dev/null;'
+        ' [ $(($1 % {0})) -eq 0 ] ||'
+        ' dd bs=$(($1 % {0})) count=1 iflag=fullblock 2>/dev/null; }}'
+        .format(bs),
+    ]
+    if allow_test_sw:
+        script.append('touch /tmp/allow_test_software')
+
+    for target, size in zip(targets, sizes):
+        script.extend([
+            'destpath={}'.format(target.destpath),
+            'readn {0} >"$destpath.tmp" &&'
+            ' [ $(wc -c <"$destpath.tmp") -eq {0} ] &&'
+            ' mv "$destpath.tmp" "$destpath" || exit 1'.format(size),
+        ])
+
+    own_hooks, shared_hooks = [], []
+    for target in targets:
+        if target.posthook is None:
+            continue
+        elif '$destpath' in target.posthook or '${destpath' in target.posthook:
+            own_hooks.extend(
+                ['destpath={}'.format(target.destpath), target.posthook])
+        elif target.posthook not in shared_hooks:
+            shared_hooks.append(target.posthook)
+
+    return '; '.join(script + own_hooks + shared_hooks)
+
+
 def ssh_address(address):
     '''Format IPv6 addresses to be compatible with SSH command line.'''
+    import ipaddress
+    import loadsutil
+
     try:
         addr = ipaddress.IPv6Address(address)
         # For link-local addresses that do not already specify the appropriate
@@ -248,64 +358,263 @@ def ssh_address(address):
     return address
 
 
-def build_ssh_cmd(user, destination, remote_cmd, *, ssh='ssh'):
-    opts = '-o "StrictHostKeyChecking=no" -o "UserKnownHostsFile=/dev/null"'
-    return '{} {} {}@{} {}'.format(
-        ssh, opts, user, destination, shlex.quote(remote_cmd))
+def origin_script(via=None):
+    '''Return shell command that sets $origin to how the device reaches us.
+
+    When installing 'via' another host, the device reaches us through a
+    reverse SSH tunnel on its loopback interface (see build_ssh_argv()).
+    '''
+    if via:
+        return 'origin=127.0.0.1'
+    return 'origin=$(echo $SSH_CLIENT | cut -d" " -f1)'
+
+
+def build_ssh_argv(user, destination, remote_cmd, *, ssh='ssh',
+                   forward_port=None, multiplex=False, transport=None):
+    '''Build SSH argv for running 'remote_cmd' on 'destination'.
+
+    If 'forward_port' is given, that port on the remote host's loopback
+    interface is forwarded back to the same port on our loopback interface.
+    If 'multiplex' is set, the SSH connection is kept open for a while after
+    the command finishes, and reused by subsequent (multiplexed) commands,
+    which then do not need to set up a new connection.
+    If 'transport' is given, it is a dict with the 'cipher', 'mac' and
+    'compression' settings to use for the connection (see calibrate()).
+    To run a command via another host, pass the argv for the inner hop
+    through shell_cmd() into the 'remote_cmd' for the outer hop.
+    '''
+    argv = shlex.split(ssh) + [
+        '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null']
+    if transport:
+        argv += ssh_transport_args(**transport)
+    if multiplex:
+        argv += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/binst-%C',
+                 '-o', 'ControlPersist=10m']
+    if forward_port is not None:
+        argv += ['-o', 'ExitOnForwardFailure=yes',
+                 '-R', '{0}:127.0.0.1:{0}'.format(forward_port)]
+    return argv + ['{}@{}'.format(user, destination), remote_cmd]
+
+
+def shell_cmd(argv):
+    '''Return shell command line corresponding to the given argv.'''
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
+def build_ssh_cmd(user, destination, remote_cmd, **kwargs):
+    '''Like build_ssh_argv(), but return a shell command line.'''
+    return shell_cmd(build_ssh_argv(user, destination, remote_cmd, **kwargs))
+
+
+def ssh_transport_args(cipher=None, mac=None, compression=False, **_):
+    '''Return SSH options selecting the given cipher/MAC/compression.'''
+    args = []
+    if cipher:
+        args += ['-c', cipher]
+    if mac:
+        args += ['-m', mac]
+    return args + ['-o', 'Compression={}'.format('yes' if compression else 'no')]
+
+
+def ssh_transport_opts(**transport):
+    return shell_cmd(ssh_transport_args(**transport))
+
+
+def load_ssh_profile(path=SSH_PROFILE_PATH):
+    '''Return the SSH transport settings stored by calibrate(), per target.'''
+    import json
+
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.warning('Ignoring malformed {}: {}'.format(path, e))
+        return {}
+
+
+def save_ssh_profile(profile, path=SSH_PROFILE_PATH):
+    import json
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(profile, f, indent=4, sort_keys=True)
+    tmp.rename(path)
+
+
+def calibrate(sample, ssh_cmd_for, *, rounds=2):
+    '''Find the fastest SSH transport settings for streaming to a device.
+
+    Stream the 'sample' bytes through each candidate combination of cipher/MAC
+    (from SSH_TRANSPORTS) with SSH compression off and on, and time it. The
+    'ssh_cmd_for' callable must return the SSH argv for running the given
+    remote command with the given transport settings (a dict to pass on to
+    build_ssh_argv()). The time to set up the connection is measured with an
+    empty transfer, and subtracted. The best of 'rounds' runs is used.
+
+    Yield (transport, throughput in bytes/sec) for each candidate, with a
+    throughput of None for candidates not supported by either end.
+    '''
+    def timed(cmd, data):
+        start = now()
+        proc = subprocess.run(
+            cmd, input=data,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return now() - start if proc.returncode == 0 else None
+
+    for cipher, mac in SSH_TRANSPORTS:
+        for compression in (False, True):
+            transport = {
+                'cipher': cipher, 'mac': mac, 'compression': compression}
+            cmd = ssh_cmd_for('cat >/dev/null', transport)
+            best = None
+            for _ in range(rounds):
+                baseline, elapsed = timed(cmd, b''), timed(cmd, sample)
+                if baseline is None or elapsed is None:
+                    break
+                rate = len(sample) / max(elapsed - baseline, 1e-3)
+                best = rate if best is None else max(best, rate)
+            yield transport, best
+
+
+def resume_offset(image_path, ssh_argv):
+    '''Return how much of 'image_path' is already stored on the device.
+
+    Run 'ssh_argv' (which should run a BinstTarget.partial_script() on the
+    device) to find the size and checksum of a partially transferred image on
+    the device. If that matches the same prefix of the local 'image_path',
+    return its size (i.e. where to resume the transfer), otherwise return 0.
+    '''
+    import loadsutil
+
+    try:
+        output = subprocess.check_output(
+            ssh_argv, stdin=subprocess.DEVNULL,
+            universal_newlines=True).split()
+        size, checksum = int(output[0]), output[1]
+    except (subprocess.CalledProcessError, IndexError, ValueError):
+        return 0  # Nothing (usable) found
+
+    if not 0 < size <= image_path.stat().st_size:
+        return 0
+    if loadsutil.sha512sum(image_path, size) != checksum:
+        return 0
+    return size
+
+
+def find_prebuilt_loads(loadsdir, image_path=None, target=None):
+    '''Return the .loads file in a prebuilt 'loadsdir' (see loadsdir --watch).
+
+    Return None if there is no .loads file, or if it is older than the given
+    'image_path' (i.e. the loads dir is not yet updated after a rebuild). If
+    the (loadsfile) 'target' is also given, return None unless the .loads
+    file refers to 'image_path' (by checksum) for that target's product, as
+    the loads dir may have been built from another objdir or build.
+    '''
+    for path in loadsdir.glob('*.loads'):
+        if path.name.endswith('.pkg.loads'):
+            continue
+        if image_path and path.stat().st_mtime < image_path.stat().st_mtime:
+            return None
+        if image_path and target:
+            import loadsfile
+            import loadsutil
+
+            try:  # use an up-to-date .pkg.loads fragment, if available
+                checksum = loadsfile.PkgLoads(image_path).checksum
+            except ValueError:
+                checksum = loadsutil.sha512sum(image_path)
+            if not any(e['product'] == target.product and
+                       e['checksum'] == checksum
+                       for e in loadsfile.LoadsFile.parse(path)):
+                return None
+        return path
+    return None
 
 
 class LoadsServer:
+    '''Serve a loads dir for the given target/PKG over HTTP.'''
+
+    server = None  # until set up by __init__()
+    _tmpdir = None
+    _held = None  # fd holding on to a prebuilt loads dir
+
     @staticmethod
     def _prepare_loadsdir(where, target, target_pkg, objdir):
+        import loadsdir
+        import loadsfile
+
         if target_pkg == Path('-'):  # PKG on stdin
+            # Hash while storing, and leave a .pkg.loads file next to the PKG,
+            # so that building the loads dir need not read the PKG again.
             target_pkg = where / 'target.pkg'
-            with target_pkg.open('wb') as f:
-                shutil.copyfileobj(sys.stdin.buffer, f)
+            loadsfile.store_pkg_stream(target, sys.stdin.buffer, target_pkg)
 
         try:
             loads_path = loadsdir.build_with_deps(
                 where, target, pkg=target_pkg, objdir=objdir)
-        except RuntimeError as e:
-            print(e.args)
-            print('Either rerun with --no-loads or build these targets first!')
-            sys.exit(1)
+        except (RuntimeError, ValueError) as e:  # e.g. missing PKGs
+            raise InstallError(
+                '{}: Either use --no-loads or build these targets first!'
+                .format(e)) from e
 
         return loads_path.relative_to(where)
 
-    # Use ForkingTCPServer to serve multiple requests simultaneously
-    class BinstServer(socketserver.ForkingTCPServer):
-        def __init__(self, *args, **kwargs):
-            self.has_timed_out = False
-            super().__init__(*args, **kwargs)
-
-        def handle_timeout(self):
-            self.has_timed_out = True
-
-    def __init__(self, binst_target, target_pkg, objdir):
-        self._tmpdir = TemporaryDirectory()
-        self.loadsdir = Path(self._tmpdir.name)
-        loads_target = loadsfile.Targets[binst_target.loadsname]
-        self.loadspath = self._prepare_loadsdir(
-            self.loadsdir, loads_target, target_pkg, objdir)
+    def __init__(self, binst_target, target_pkg, objdir, prebuilt=None):
+        import loadsdir
+        from socketserver import ThreadingTCPServer
+        from tempfile import TemporaryDirectory
+
+        # Use ThreadingTCPServer to serve multiple requests simultaneously
+        # (not ForkingTCPServer, as we may be running in one of many threads)
+        class BinstServer(ThreadingTCPServer):
+            def __init__(self, *args, **kwargs):
+                self.has_timed_out = False
+                super().__init__(*args, **kwargs)
+
+            def handle_timeout(self):
+                self.has_timed_out = True
+
+        if prebuilt is None:
+            self._tmpdir = TemporaryDirectory()
+            self.loadsdir = Path(self._tmpdir.name)
+            self.loadspath = self._prepare(binst_target, target_pkg, objdir)
+        else:  # serve a loads dir that was already built for us
+            # Hold on to the current generation, so that "loadsdir --watch"
+            # does not remove it while we serve it (even if it swaps in a
+            # newer one meanwhile).
+            self.loadsdir, self._held = loadsdir.hold_loads_dir(prebuilt)
+            self.loadspath = find_prebuilt_loads(self.loadsdir).relative_to(
+                self.loadsdir)
 
         # Setup a simple HTTP server to serve files from self.loadsdir.
         self.server = loadsdir.http_server(
-            self.loadsdir, Server=self.BinstServer)
+            self.loadsdir, Server=BinstServer)
         self.port = self.server.server_address[1]
 
-    def serve(self):
-        print('Serving loads upgrade from {} over port {}...'.format(
+    def _prepare(self, binst_target, target_pkg, objdir):
+        import loadsfile
+
+        loads_target = loadsfile.Targets[binst_target.loadsname]
+        return self._prepare_loadsdir(
+            self.loadsdir, loads_target, target_pkg, objdir)
+
+    def serve(self, first_timeout=5):
+        logger.info('Serving loads upgrade from {} over port {}...'.format(
             self.loadsdir, self.port))
-        print('Press Ctrl+C to abort at any time')
-        print('Waiting for up to 5 seconds for first request...')
-        self.server.timeout = 5
+        logger.info('Waiting for up to {} seconds for first request...'.format(
+            first_timeout))
+        self.server.timeout = first_timeout
         self.server.handle_request()
         if self.server.has_timed_out:
-            print('No incoming requests. Aborting.')
+            logger.info('No incoming requests. Aborting.')
             self.cleanup()
             return False
         else:
-            print('Incoming request. Will quit 30s after the last request.')
+            logger.info(
+                'Incoming request. Will quit 30s after the last request.')
             self.server.timeout = 30
             start = now()
             while now() - start < self.server.timeout:
@@ -315,13 +624,752 @@ class LoadsServer:
             return True
 
     def cleanup(self):
-        self.server.server_close()
-        self._tmpdir.cleanup()
+        if self.server is not None:
+            self.server.server_close()
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+        if self._held is not None:
+            os.close(self._held)
+            self._held = None
 
     def __del__(self):
         self.cleanup()
 
 
+class ImageServer(LoadsServer):
+    '''Serve a single image over HTTP, for the device to fetch by itself.'''
+
+    def _prepare(self, binst_target, image_path, objdir):
+        import loadsutil
+
+        served = self.loadsdir / (binst_target.name + '.img')
+        if image_path == Path('-'):  # image on stdin
+            with served.open('wb') as f:
+                self.checksum = loadsutil.copy_and_sha512sum(
+                    sys.stdin.buffer, f)
+        else:
+            served.symlink_to(image_path.resolve())
+            self.checksum = loadsutil.sha512sum(image_path)
+        return served.relative_to(self.loadsdir)
+
+    def serve_while(self, proc):
+        '''Serve requests for as long as the given process is running.'''
+        logger.info('Serving {} over port {} until device is done...'.format(
+            self.loadsdir / self.loadspath, self.port))
+        self.server.timeout = 1
+        while proc.poll() is None:
+            self.server.handle_request()
+        self.cleanup()
+        return proc.returncode
+
+
+class History:
+    '''Outcomes of earlier installs, kept in an SQLite database at 'db_path'.
+
+    For each install, we record the destination, target(s), the method used
+    ('loads', 'pull' or 'stream'), the --via host (if any), the number of bytes
+    transferred (if known), how long it took and whether it succeeded. This is
+    used to estimate how long a new install will take with each method.
+    '''
+
+    SCHEMA = '''
+CREATE TABLE IF NOT EXISTS installs (
+    time INTEGER NOT NULL,
+    destination TEXT NOT NULL,
+    target TEXT NOT NULL,
+    method TEXT NOT NULL,
+    via TEXT,
+    bytes INTEGER,
+    seconds REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS installs_dest ON installs (destination, target);
+'''
+    RECENT = 10  # only look at this many recent installs per method
+
+    def __init__(self, db_path=HISTORY_DB_PATH):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        import sqlite3
+
+        self.db = sqlite3.connect(str(db_path))
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, destination, target, method, via, size, seconds, ok):
+        with self.db:
+            self.db.execute(
+                'INSERT INTO installs VALUES'
+                ' (strftime(\'%s\', \'now\'), ?, ?, ?, ?, ?, ?, ?)',
+                (destination, target, method, via, size, seconds, bool(ok)))
+
+    def vias(self, destination):
+        '''Return the --via hosts that have been used for 'destination'.'''
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT via FROM installs WHERE destination = ? AND'
+            ' via IS NOT NULL ORDER BY via', (destination,))]
+
+    def estimate(self, destination, target, method, via, size=None):
+        '''Estimate how many seconds an install with 'method' would take.
+
+        Use the median throughput of recent successful installs (or their
+        median duration, if their sizes are unknown), applied to the given
+        'size' (or to the size of the last successful install with 'method',
+        e.g. when a loads install also transfers the PKGs of dependencies, of
+        unknown size). To compare methods, pass the same kind of 'size'.
+        Failed installs are accounted for by dividing by the recent success
+        rate, so that an occasional failure makes a method less attractive,
+        without ruling it out for good. Return (seconds, number of installs
+        used), or None if there are no recent successful installs.
+        '''
+        rows = self.db.execute(
+            'SELECT bytes, seconds, ok FROM installs WHERE destination = ? AND'
+            ' target = ? AND method = ? AND via IS ? ORDER BY rowid DESC'
+            ' LIMIT ?', (destination, target, method, via, self.RECENT))
+        rows = list(rows)
+        ok = [(b, s) for b, s, good in rows if good]
+        if not ok:
+            return None
+        penalty = len(rows) / len(ok)  # expected attempts per success
+
+        def median(values):
+            return sorted(values)[len(values) // 2]
+
+        rates = [b / s for b, s in ok if b and s > 0]
+        if rates:
+            if size is None:
+                size = next(b for b, _ in ok if b)
+            return penalty * size / median(rates), len(ok)
+        return penalty * median([s for _, s in ok]), len(ok)
+
+    def choose(self, destination, target, candidates, size=None):
+        '''Return the fastest (method, via) among 'candidates', by history.
+
+        Return ((method, via), estimated seconds, number of installs used), or
+        None if there is no history for any of the candidates.
+        '''
+        best = None
+        for method, via in candidates:
+            estimate = self.estimate(destination, target, method, via, size)
+            if estimate is not None and (best is None or estimate < best[1:]):
+                best = ((method, via),) + estimate
+        return best
+
+
+class InstallError(Exception):
+    '''An install() could not be carried out.'''
+
+
+class InstallOptions:
+    '''Options for install(), mirroring binst's command-line options.
+
+    loads: Upgrade via .loads file (True), or via .pkg file (False). If None,
+        choose by history, or by the target's prefer_loads flag.
+    pull: Let device fetch image over HTTP instead of streaming it over SSH
+        (overrides the prefer_loads default, cannot be combined with loads).
+    objdir: Pick install file(s) from this path.
+    loads_dir: Serve up-to-date loads dirs kept here by "loadsdir.py --watch"
+        instead of building one.
+    file: Install this specific image (Path('-') to read it from stdin).
+    allow_test_software: Allow installing test S/W on top of release S/W.
+    unprod: Move from release S/W using remotesupport user, which must
+        already have been created on the device.
+    install_args: Extra arguments to installimage on device.
+    via: Install via this host. If None, it may be chosen by history.
+    resume: Resume interrupted transfers of *.apps/*.gui images.
+    history: Record this install in (and choose methods based on) History.
+    multiplex: Keep SSH connections open for subsequent installs.
+    rate_limit: Stream image(s) at no more than this many bytes/sec.
+    shared_rate_limit: Share this many bytes/sec fairly among all streaming
+        installs on this host that use it (see SharedRateLimiter).
+    output: Where SSH output goes (passed as stdout/stderr to subprocess).
+    progress: Callable invoked with (bytes sent, total bytes or None) while
+        streaming an image.
+    '''
+
+    def __init__(self, *, loads=None, pull=False, objdir=None,
+                 loads_dir=None, file=None, allow_test_software=False,
+                 unprod=False, install_args='', via=None, resume=True,
+                 history=True, multiplex=False, rate_limit=None,
+                 shared_rate_limit=None, output=None, progress=None):
+        self.loads = loads
+        self.pull = pull
+        self.objdir = objdir
+        self.loads_dir = loads_dir
+        self.file = file
+        self.allow_test_software = allow_test_software
+        self.unprod = unprod
+        self.install_args = install_args
+        self.via = via
+        self.resume = resume
+        self.history = history
+        self.multiplex = multiplex
+        self.rate_limit = rate_limit
+        self.shared_rate_limit = shared_rate_limit
+        self.output = output
+        self.progress = progress
+
+    def check(self, targets):
+        '''Raise ValueError if these options cannot be used for 'targets'.'''
+        for target in targets:
+            if self.unprod and not target.is_remotesupport_compatible():
+                raise ValueError('''
+Cannot combine -u/--unprod with target {}!
+Target does not support installation with sudo, root access is necessary.
+'''.format(target.name))
+
+        if len(targets) > 1:
+            names = [t.name for t in targets]
+            if len(set(names)) != len(names):
+                raise ValueError(
+                    'Cannot install the same target more than once!')
+            for target in targets:
+                if target.destpath is None:
+                    raise ValueError('''
+Cannot combine target {} with other targets!
+Only targets that are stored at a destpath (e.g. *.apps/*.gui) can be combined.
+'''.format(target.name))
+                if target.ssh != targets[0].ssh:
+                    raise ValueError(
+                        'Cannot combine targets using different SSH!')
+            if self.loads or self.pull or self.file:
+                raise ValueError(
+                    'Cannot combine multiple targets with --loads/--pull/'
+                    '--file!')
+
+        if self.unprod and self.pull:
+            raise ValueError('Cannot combine -u/--unprod with --pull!')
+
+        if self.loads and self.pull:
+            raise ValueError('Cannot combine --loads with --pull!')
+
+        if (self.rate_limit or self.shared_rate_limit) and (
+                self.loads or self.pull):
+            raise ValueError('Cannot combine --rate-limit/--shared-rate-limit '
+                             'with --loads/--pull!')
+
+
+class InstallResult:
+    '''Outcome of an install().
+
+    ok: Whether the install succeeded.
+    method: How the image(s) were installed: 'loads', 'pull' or 'stream'.
+    via: The host we installed via (if any).
+    image_paths: The installed image(s).
+    bytes: How many bytes were transferred (if known).
+    eta: The estimated duration of the install (from History), if any.
+    phases: List of (phase name, seconds) in the order they were performed.
+    errors: List of error messages.
+    '''
+
+    def __init__(self):
+        self.ok = False
+        self.method = None
+        self.via = None
+        self.image_paths = []
+        self.bytes = None
+        self.eta = None
+        self.phases = []
+        self.errors = []
+
+    def __repr__(self):
+        return '{}(ok={!r}, method={!r}, phases={!r}, errors={!r})'.format(
+            self.__class__.__name__, self.ok, self.method, self.phases,
+            self.errors)
+
+    @contextmanager
+    def phase(self, name):
+        '''Time the enclosed block as the given phase of the install.'''
+        start = now()
+        try:
+            yield
+        finally:
+            self.phases.append((name, now() - start))
+
+
+class RateLimiter:
+    '''Token bucket limiting a stream to 'rate' bytes/sec.
+
+    Call wait(n) before sending each block of (at most) 'block_size' bytes,
+    which may change along with the rate. Up to 'burst' bytes (default: one
+    block_size) may be sent without waiting after a pause.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.fixed_burst = burst
+        self.set_rate(rate)
+        self.tokens = 0
+        self.last = now()
+
+    def set_rate(self, rate):
+        '''Limit to 'rate' bytes/sec from now on, and adjust block_size.'''
+        self.rate = rate
+        # Use smaller blocks when slow, to avoid sending in long, bursty gaps
+        self.block_size = max(16 * 1024, min(1024 * 1024, int(rate) // 10))
+        self.burst = self.block_size if self.fixed_burst is None else (
+            self.fixed_burst)
+
+    def wait(self, nbytes):
+        t = now()
+        self.tokens = min(
+            self.burst, self.tokens + (t - self.last) * self.rate)
+        self.last = t
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+    def close(self):
+        pass
+
+
+class SharedRateLimiter(RateLimiter):
+    '''Share a 'ceiling' of bytes/sec fairly among all concurrent streams.
+
+    All SharedRateLimiters (in this and other binst processes on this host,
+    run by any user) that use the same 'path' register a file of their own
+    in that directory, and each limit themselves to an equal share of the
+    'ceiling' (and to their own 'limit', if given). Shares are recalculated
+    every REFRESH seconds, so that a new stream (e.g. an interactive push)
+    gets its fair share right away, and the others speed up again when it is
+    done. Each stream only ever writes its own file, so no shared file needs
+    to be writable by other users; files left behind by dead or stalled
+    processes are not counted.
+
+    If 'path' cannot safely be shared with other users (e.g. it was created
+    by another user, without the sticky, world-writable mode of /tmp), fall
+    back to a per-user directory next to it, i.e. only share the 'ceiling'
+    among our own streams, with a warning.
+    '''
+
+    REFRESH = 1.0  # seconds between share updates
+    STALE = 10.0  # ignore streams that have not refreshed for this long
+
+    def __init__(self, ceiling, path=SHARED_RATE_DIR, limit=None):
+        self.ceiling = ceiling
+        self.path = path
+        self.limit = limit
+        problem = self._prepare(path, 0o1777)  # like /tmp: anyone may add
+        if problem is not None:
+            own_path = path.with_name('{}-{}'.format(path.name, os.getuid()))
+            logger.warning('Cannot share rate limit with other users in {}: '
+                           '{}, sharing it only among streams in {}'.format(
+                               path, problem, own_path))
+            path = self.path = own_path
+            problem = self._prepare(path, 0o700)
+            if problem is not None:
+                raise InstallError(
+                    'Cannot use {} for rate limiting: {}'.format(
+                        path, problem))
+        self.own = path / '{}-{}'.format(os.getpid(), id(self))
+        self.refreshed = None
+        super().__init__(self._update())
+
+    @staticmethod
+    def _prepare(path, mode):
+        '''Create directory 'path' with 'mode', or check the existing one.
+
+        An existing directory must be either ours (then it is given 'mode'),
+        or, if 'mode' is that of /tmp, be sticky and writable by all. Return
+        None if OK, or what is wrong with it.
+        '''
+        import stat
+
+        try:
+            path.mkdir(mode & 0o777)
+        except FileExistsError:
+            pass
+        st = os.lstat(str(path))
+        if not stat.S_ISDIR(st.st_mode):
+            return 'not a directory'
+        if st.st_uid == os.getuid():
+            if stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(str(path), mode)
+            return None
+        if mode != 0o1777 or stat.S_IMODE(st.st_mode) & 0o1777 != 0o1777:
+            return 'owned by uid {} with mode {:o}'.format(
+                st.st_uid, stat.S_IMODE(st.st_mode))
+        return None
+
+    def _update(self):
+        '''Refresh our own file, and return our current share.'''
+        self.own.touch()  # (re)creates it, if removed as stale
+        t = time.time()
+        streams = 0
+        for entry in os.scandir(str(self.path)):
+            try:
+                pid = int(entry.name.split('-')[0])
+                fresh = t - entry.stat().st_mtime <= self.STALE
+            except (OSError, ValueError):  # gone already, or not ours
+                continue
+            if fresh and self._alive(pid):
+                streams += 1
+            else:  # left behind by a dead process, clean up (if we may)
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+        self.refreshed = now()
+
+        share = self.ceiling / max(streams, 1)
+        return share if self.limit is None else min(share, self.limit)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # belongs to another user
+            pass
+        return True
+
+    def wait(self, nbytes):
+        if now() - self.refreshed >= self.REFRESH:
+            rate = self._update()
+            if rate != self.rate:
+                logger.debug('Rate limit is now {:.0f} KiB/s'.format(
+                    rate / 1024))
+                self.set_rate(rate)
+        super().wait(nbytes)
+
+    def close(self):
+        try:
+            self.own.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def stream_images(sources, proc, *, offset=0, progress=None, limiter=None):
+    '''Stream the given image 'sources' into the stdin of 'proc'.
+
+    The 'sources' are paths (or Path('-') for our stdin), which are streamed
+    back-to-back, skipping the first 'offset' bytes of the first source. If
+    given, 'progress' is called with (bytes sent, total bytes or None) after
+    each block. If given, 'limiter' (a RateLimiter) paces the blocks. Return
+    the number of bytes sent.
+    '''
+    import loadsutil
+
+    if Path('-') in sources:
+        total = None
+    else:
+        total = sum(p.stat().st_size for p in sources) - offset
+    sent = 0
+    try:
+        for i, source in enumerate(sources):
+            if source == Path('-'):
+                f = open(sys.stdin.fileno(), 'rb', closefd=False)
+            else:
+                f = source.open('rb')
+            with f:
+                if i == 0 and offset:
+                    f.seek(offset)
+                while True:
+                    chunk = f.read(loadsutil.READ_SIZE if limiter is None
+                                   else limiter.block_size)
+                    if not chunk:
+                        break
+                    if limiter is not None:
+                        limiter.wait(len(chunk))
+                    proc.stdin.write(chunk)
+                    sent += len(chunk)
+                    if progress is not None:
+                        progress(sent, total)
+        proc.stdin.close()
+    except BrokenPipeError:  # remote end gave up, its exit code tells why
+        pass
+    return sent
+
+
+def install(target, destination, options=None):
+    '''Install image(s) for the given target(s) on 'destination'.
+
+    'target' is a target name or BinstTarget instance, or a list of them (to
+    install several targets in one go). 'options' is an InstallOptions
+    instance (default: InstallOptions()). Progress is reported through the
+    'binst' logger. Nothing is printed or prompted for, and this may be called
+    from several threads at once. Return an InstallResult.
+
+    Raise ValueError if a target name is unknown, or if 'options' cannot be
+    used for the given target(s).
+    '''
+    if options is None:
+        options = InstallOptions()
+    targets = target if isinstance(target, (list, tuple)) else [target]
+    targets = [t if isinstance(t, BinstTarget) else BinstTarget.create(t)
+               for t in targets]
+    options.check(targets)
+
+    result = InstallResult()
+    history = None
+    if options.history:
+        import sqlite3
+
+        try:
+            history = History()
+        except sqlite3.Error as e:
+            logger.warning('Not using install history: {}'.format(e))
+    try:
+        _install(targets, destination, options, result, history)
+    except (InstallError, OSError, subprocess.SubprocessError) as e:
+        result.errors.append(str(e))
+    finally:
+        if history is not None:
+            history.close()
+    return result
+
+
+def _install(targets, destination, opts, result, history):
+    target = targets[0]
+    logger.info('Installing {}'.format(', '.join(t.name for t in targets)))
+    for t in targets:
+        logger.info(t.description)
+
+    with result.phase('prepare'):
+        logger.info('Determining local image path...')
+        if opts.file:
+            image_paths = [opts.file]
+        else:
+            try:
+                image_paths = [t.find_image(opts.objdir) for t in targets]
+            except subprocess.CalledProcessError as e:
+                raise InstallError('Cannot find image: {}'.format(e)) from e
+        for t, image_path in zip(targets, image_paths):
+            if not image_path.exists() and image_path != Path('-'):
+                raise InstallError('Cannot find {} image at {}'.format(
+                    t.name, image_path))
+            logger.info('File: {}'.format(image_path))
+        image_path = image_paths[0]
+        result.image_paths = image_paths
+        if Path('-') in image_paths:
+            image_size = None
+        else:
+            image_size = sum(p.stat().st_size for p in image_paths)
+
+        loads, pull, via = opts.loads, opts.pull, opts.via
+        # Only streaming is rate limited, so stick to that when limiting
+        limited = bool(opts.rate_limit or opts.shared_rate_limit)
+        if (loads is None and target.prefer_loads and not pull and
+                not limited):
+            loads = True
+        # Let history choose between methods that install the same content,
+        # i.e. not for targets whose --no-loads excludes their peripherals
+        auto_method = (opts.loads is None and not pull and not limited and
+                       not target.prefer_loads and len(targets) == 1)
+
+        history_key = '+'.join(t.name for t in targets)
+        choice = None
+        if history is not None:
+            import sqlite3
+
+            method = 'loads' if loads else 'pull' if pull else 'stream'
+            methods, vias = [method], [via]
+            if auto_method:
+                methods = ['stream']
+                if target.support_loads():
+                    methods.append('loads')
+                if not opts.unprod:
+                    methods.append('pull')
+            try:
+                if opts.via is None:
+                    vias += history.vias(destination)
+                # Price all methods at the image size, except loads on its
+                # own (which also transfers its dependencies, see estimate())
+                choice = history.choose(
+                    destination, history_key,
+                    [(m, v) for m in methods for v in vias],
+                    None if methods == ['loads'] else image_size)
+            except sqlite3.Error as e:  # e.g. locked by a concurrent install
+                logger.warning('Cannot use install history: {}'.format(e))
+            if choice is not None:
+                (method, via), result.eta, installs = choice
+                if auto_method:
+                    loads, pull = method == 'loads', method == 'pull'
+                flag = {'loads': '--loads', 'pull': '--pull'}.get(
+                    method, '--no-loads')
+                logger.info(
+                    'Using {}{}, expected to take {:.0f}s (based on {} '
+                    'earlier installs)'.format(
+                        flag, '' if via is None else ' --via ' + via,
+                        result.eta, installs))
+        result.via = via
+
+        logger.info('Destination: {}'.format(destination))
+        if via:
+            logger.info('Via: {}'.format(via))
+
+        if opts.unprod:
+            remote_user = 'remotesupport'
+            allow_test_sw = True
+            sudo = 'sudo'
+        else:
+            remote_user = 'root'
+            allow_test_sw = opts.allow_test_software
+            sudo = ''
+
+        transport = load_ssh_profile().get(target.name)
+        if transport:
+            logger.info('SSH settings (from --calibrate): {}'.format(
+                ssh_transport_opts(**transport)))
+
+    def ssh_argv(script, forward_port=None):
+        argv = build_ssh_argv(
+            remote_user, ssh_address(destination), script, ssh=target.ssh,
+            forward_port=forward_port, multiplex=opts.multiplex,
+            transport=transport)
+        if via:
+            argv = build_ssh_argv(
+                remote_user, ssh_address(via), shell_cmd(argv),
+                forward_port=forward_port, multiplex=opts.multiplex)
+        logger.debug('Running: {}'.format(shell_cmd(argv)))
+        return argv
+
+    def record(method, size, seconds, ok, keep=True):
+        result.method, result.bytes, result.ok = method, size, ok
+        if history is not None and keep:
+            import sqlite3
+
+            try:
+                history.record(destination, history_key, method, via, size,
+                               seconds, ok)
+            except sqlite3.Error as e:
+                logger.warning('Cannot record install history: {}'.format(e))
+
+    output = {'stdout': opts.output, 'stderr': opts.output}
+
+    if loads:
+        assert target.support_loads()
+        import loadsfile
+
+        # PKGs may have been rebuilt since an earlier install() in this process
+        loadsfile.pkg_info.cache_clear()
+        start = now()
+        with result.phase('loads'):
+            prebuilt = None
+            if opts.loads_dir and not opts.file:
+                prebuilt = opts.loads_dir / target.loadsname
+                if find_prebuilt_loads(
+                        prebuilt, image_path,
+                        loadsfile.Targets[target.loadsname]) is None:
+                    logger.info('No up-to-date loads dir for {} at {}'.format(
+                        image_path, prebuilt))
+                    prebuilt = None
+                else:
+                    logger.info('Using loads dir at {}'.format(prebuilt))
+            server = LoadsServer(target, image_path, opts.objdir, prebuilt)
+            if via:
+                # The device cannot reach us directly. Instead, tunnel the
+                # device's loopback port back to our server via 'via', and
+                # keep the SSH connections (and thus the tunnel) open until
+                # we're done serving.
+                keepalive = ['exec cat >/dev/null']
+                forward_port = server.port
+            else:
+                keepalive = []
+                forward_port = None
+            script = '; '.join([
+                origin_script(via),
+                'upgrade_url="http://$origin:{0.port}/{0.loadspath}"'.format(
+                    server),
+                'echo "xcom SystemUnit SoftwareUpgrade URL: $upgrade_url" | '
+                'tsh',
+            ] + keepalive)
+            argv = ssh_argv(script, forward_port)
+            logger.info('Triggering {} to upgrade from our port {}...'.format(
+                destination, server.port))
+            if via:
+                tunnel = subprocess.Popen(
+                    argv, stdin=subprocess.PIPE, **output)
+                served = server.serve(first_timeout=30)  # 2x SSH setup
+                tunnel.stdin.close()  # EOF to remote 'cat' closes the tunnel
+                triggered = tunnel.wait() == 0 or served
+            else:
+                triggered = subprocess.call(
+                    argv, stdin=subprocess.DEVNULL, **output) == 0
+                # Hand control over to loads server.
+                served = triggered and server.serve()
+            server.cleanup()
+        record('loads', server.server.metrics.summary()['bytes'],
+               now() - start, triggered and served)
+        if not triggered:
+            result.errors.append('Failed to trigger upgrade (command: {})'
+                                 .format(shell_cmd(argv)))
+        elif served:  # Files were served to destination. We're done.
+            return
+        else:  # Destination failed to request anything from us.
+            result.errors.append(
+                'No upgrade requests from {}!'.format(destination))
+        logger.info('Falling back to old/--no-loads behavior...')
+
+    if pull:
+        start = now()
+        with result.phase('pull'):
+            server = ImageServer(target, image_path, opts.objdir)
+            url = 'http://$origin:{0.port}/{0.loadspath}'.format(server)
+            script = '; '.join([origin_script(via), target.remote_script(
+                allow_test_sw, sudo, opts.install_args or '',
+                image_url=url, checksum=server.checksum)])
+            argv = ssh_argv(script, server.port if via else None)
+            logger.info('Connecting...')
+            returncode = server.serve_while(subprocess.Popen(
+                argv, stdin=subprocess.DEVNULL, **output))
+        record('pull', server.server.metrics.summary()['bytes'],
+               now() - start, returncode == 0)
+        if returncode != 0:
+            result.errors.append('Failed to install image (command: {})'
+                                 .format(shell_cmd(argv)))
+        return
+
+    offset, size = 0, None
+    if len(targets) > 1:  # stream all images over a single connection
+        script = combined_remote_script(
+            targets, [p.stat().st_size for p in image_paths], allow_test_sw)
+    else:
+        if opts.resume and target.destpath and image_path != Path('-'):
+            with result.phase('resume'):
+                logger.info('Looking for interrupted transfer on device...')
+                size = image_path.stat().st_size
+                offset = resume_offset(
+                    image_path, ssh_argv(target.partial_script()))
+                if offset:
+                    logger.info('Resuming transfer at byte {} of {}'.format(
+                        offset, size))
+        script = target.remote_script(
+            allow_test_sw, sudo, opts.install_args or '',
+            offset=offset, size=size)
+
+    if opts.shared_rate_limit:
+        limiter = SharedRateLimiter(
+            opts.shared_rate_limit, limit=opts.rate_limit)
+    elif opts.rate_limit:
+        limiter = RateLimiter(opts.rate_limit)
+    else:
+        limiter = None
+    if limiter is not None:
+        logger.info('Limiting transfer to {:.0f} KiB/s'.format(
+            limiter.rate / 1024))
+
+    start = now()
+    with result.phase('stream'):
+        argv = ssh_argv(script)
+        logger.info('Connecting...')
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE, **output)
+        try:
+            sent = stream_images(image_paths, proc, offset=offset,
+                                 progress=opts.progress, limiter=limiter)
+        finally:
+            if limiter is not None:
+                limiter.close()
+        returncode = proc.wait()
+    # Throttled transfers would skew estimates, so keep them out of History
+    record('stream', sent, now() - start, returncode == 0,
+           keep=limiter is None)
+    if returncode != 0:
+        result.errors.append('Failed to install image (command: {})'.format(
+            shell_cmd(argv)))
+
+
 def parse_args(*args):
     from argparse import ArgumentParser, ArgumentTypeError, Action, SUPPRESS
 
@@ -340,6 +1388,21 @@ def parse_args(*args):
                     name, '\n    '.join(sorted(TARGETS.keys()))))
         return BinstTarget.create(name)
 
+    def parse_rate(value):
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        try:
+            if value[-1:].upper() in units:
+                rate = float(value[:-1]) * units[value[-1].upper()]
+            else:
+                rate = float(value)
+        except ValueError:
+            rate = 0
+        if not rate > 0:
+            raise ArgumentTypeError(
+                'Invalid rate "{}", must be bytes/sec, optionally with K/M/G '
+                'suffix (e.g. 500K)'.format(value))
+        return rate
+
     parser = ArgumentParser(
         usage=USAGE, description=sys.modules[__name__].__doc__)
 
@@ -354,7 +1417,8 @@ def parse_args(*args):
         metavar='<target>', help='Install image for this build target.')
     target_spec.add_argument(
         '--target', '-t', dest='target_alt', type=parse_target,
-        metavar='<target>', help='Install image for this build target.')
+        action='append', metavar='<target>',
+        help='Install image for this build target. May be repeated.')
 
     parser.add_argument(
         'destination',
@@ -369,12 +1433,16 @@ def parse_args(*args):
     parser.add_argument(
         '--objdir', '-O',
         help='Pick install file from this path.')
+    parser.add_argument(
+        '--loads-dir', type=Path,
+        help='Serve up-to-date loads dirs kept here by "loadsdir.py --watch" '
+             'instead of building one (with --loads).')
     parser.add_argument(
         '--file', '-f', type=Path,
         help='Install a specific image.')
     parser.add_argument(
         '--verbose', '-v', action='store_true',
-        help='Show verbose file transfer information. Uses pv(1)')
+        help='Show verbose file transfer information.')
     parser.add_argument(
         '--allow-test-software', '-y', action='store_true',
         help='Allow installing test S/W on top of release S/W.')
@@ -387,45 +1455,148 @@ def parse_args(*args):
     parser.add_argument(
         '--via',
         help='Install via another host.')
+    parser.add_argument(
+        '--no-resume', dest='resume', action='store_false',
+        help='Do not resume interrupted transfers of *.apps/*.gui images.')
+    parser.add_argument(
+        '--watch', '-w', action='store_true',
+        help='Keep watching the image, and push it again (keeping the SSH '
+             'connection open) whenever it is rebuilt (implies --no-loads).')
+    parser.add_argument(
+        '--settle', type=float, default=2.0,
+        help='With --watch: Seconds an image must be unchanged before pushing')
+    parser.add_argument(
+        '--pull', '-p', action='store_true',
+        help='Let device fetch image over HTTP instead of streaming it over '
+             'SSH (implies --no-loads).')
+    parser.add_argument(
+        '--rate-limit', type=parse_rate, metavar='RATE',
+        help='Stream image(s) at no more than RATE bytes/sec (K/M/G suffixes '
+             'allowed, implies --no-loads).')
+    parser.add_argument(
+        '--shared-rate-limit', type=parse_rate, metavar='RATE',
+        help='Share RATE bytes/sec fairly among all binst processes on this '
+             'host that stream with this option (coordinated through {}, '
+             'implies --no-loads).'.format(SHARED_RATE_DIR))
+    parser.add_argument(
+        '--no-history', dest='history', action='store_false',
+        help='Do not record this install in (nor choose --loads/--no-loads/'
+             '--pull/--via based on) the history of earlier installs kept in '
+             '{}.'.format(HISTORY_DB_PATH))
+    parser.add_argument(
+        '--calibrate', action='store_true',
+        help='Instead of installing, measure which SSH cipher/compression '
+             'settings are fastest for this target, and use those from now '
+             'on (stored in {}).'.format(SSH_PROFILE_PATH))
 
     args = parser.parse_args(args)
 
-    # Clean up <target> positional arg vs. -t/--target value
-    if args.target_alt and not args.target:
-        args.target = args.target_alt
+    # Clean up <target> positional arg vs. -t/--target values
+    args.targets = [args.target] if args.target else args.target_alt
+    args.target = args.targets[0]
     delattr(args, 'target_alt')
 
-    if args.unprod and not args.target.is_remotesupport_compatible():
-        parser.error('''
-Cannot combine -u/--unprod with target {}!
-Target does not support installation with sudo, root access is necessary.
-'''.format(args.target.name))
-
-    if args.loads is None and args.target.prefer_loads:
-        args.loads = True
-    if args.loads and args.via:
-        parser.error('Cannot combine loads upgrade with --via!')
+    if args.watch:
+        if args.loads or args.pull or args.file == Path('-'):
+            parser.error('Cannot combine --watch with --loads/--pull/stdin!')
+        args.loads = False
+
+    if args.calibrate and (len(args.targets) > 1 or args.unprod):
+        parser.error('Cannot combine --calibrate with -u/--unprod or '
+                     'multiple targets!')
+
+    args.options = InstallOptions(
+        loads=args.loads,
+        pull=args.pull,
+        objdir=args.objdir,
+        loads_dir=args.loads_dir,
+        file=args.file,
+        allow_test_software=args.allow_test_software,
+        unprod=args.unprod,
+        install_args=args.install_args,
+        via=args.via,
+        resume=args.resume,
+        history=args.history,
+        multiplex=args.watch,
+        rate_limit=args.rate_limit,
+        shared_rate_limit=args.shared_rate_limit,
+    )
+    try:
+        args.options.check(args.targets)
+    except ValueError as e:
+        parser.error(str(e))
 
     return args
 
 
+def main_calibrate(args):
+    try:  # prefer a sample of the actual image, as that affects compression
+        with args.target.find_image(args.objdir).open('rb') as f:
+            sample = f.read(CALIBRATE_SIZE)
+    except (OSError, subprocess.CalledProcessError):
+        sample = b''
+    if len(sample) < CALIBRATE_SIZE:
+        print('No image found, calibrating with random data...')
+        sample = os.urandom(CALIBRATE_SIZE)
+
+    def ssh_cmd_for(script, transport):
+        argv = build_ssh_argv(
+            'root', ssh_address(args.destination), script,
+            ssh=args.target.ssh, transport=transport)
+        if args.via:
+            argv = build_ssh_argv('root', ssh_address(args.via),
+                                  shell_cmd(argv))
+        return argv
+
+    print('Calibrating SSH transfers of {} MiB to {} ({})...'.format(
+        len(sample) // (1024 * 1024), args.destination, args.target.name))
+    best, best_rate = None, 0
+    for transport, rate in calibrate(sample, ssh_cmd_for):
+        print('{:>30} {:30} compression={:3}: {}'.format(
+            transport['cipher'], transport['mac'] or '-',
+            'yes' if transport['compression'] else 'no',
+            'unsupported' if rate is None else
+            '{:.1f} MiB/s'.format(rate / (1024 * 1024))))
+        if rate is not None and rate > best_rate:
+            best, best_rate = transport, rate
+    if best is None:
+        print('Failed to connect to {} with any settings!'.format(
+            args.destination))
+        return 1
+
+    profile = load_ssh_profile()
+    profile[args.target.name] = dict(best, throughput=round(best_rate))
+    save_ssh_profile(profile)
+    print('Using {} for {} from now on (stored in {})'.format(
+        ssh_transport_opts(**best), args.target.name, SSH_PROFILE_PATH))
+    return 0
+
+
+def show_progress(sent, total):
+    '''Report streaming progress on stderr (see InstallOptions.progress).'''
+    mib = 1024 * 1024
+    if total:
+        line = '{:.1f} of {:.1f} MiB ({:.0%})'.format(
+            sent / mib, total / mib, sent / total)
+    else:
+        line = '{:.1f} MiB'.format(sent / mib)
+    print('\r' + line, end='\n' if sent == total else '', file=sys.stderr,
+          flush=True)
+
+
 def main(*args):
     logging.basicConfig(level=logging.INFO)
     args = parse_args(*args)
 
-    print('Installing {}'.format(args.target.name))
-    print(args.target.description)
-
-    print('Determining local image path...')
-    image_path = args.file if args.file else args.target.find_image(args.objdir)
-    if not image_path.exists() and image_path != Path('-'):
-        print('Cannot find {} image at {}'.format(args.target.name, image_path))
-        return 2
+    # Our own progress messages go to stdout, undecorated
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
 
-    print('File: {}'.format(image_path))
-    print('Destination: {}'.format(args.destination))
-    if args.via:
-        print('Via: {}'.format(args.via))
+    if args.calibrate:
+        return main_calibrate(args)
 
     if args.unprod:
         print('''
@@ -437,64 +1608,45 @@ or by using
 at the tsh and then decoding the phrase at https://rst.cisco.com
 '''.format(args.destination))
         input('Do so now and hit enter when ready...')
-        remote_user = 'remotesupport'
-        args.allow_test_software = True
-        sudo = 'sudo'
-    else:
-        remote_user = 'root'
-        sudo = ''
-
-    if args.loads:
-        assert args.target.support_loads()
-        server = LoadsServer(args.target, image_path, args.objdir)
-        script = '; '.join([
-            'origin=$(echo $SSH_CLIENT | cut -d" " -f1)',
-            'upgrade_url="http://$origin:{0.port}/{0.loadspath}"'.format(server),
-            'echo "xcom SystemUnit SoftwareUpgrade URL: $upgrade_url" | tsh',
-        ])
-        ssh_cmd = build_ssh_cmd(
-            remote_user,
-            ssh_address(args.destination),
-            script,
-            ssh=args.target.ssh)
-        print('Triggering {} to upgrade from our port {}...'.format(
-            args.destination, server.port))
-        if args.verbose:
-            print('Running: {}'.format(ssh_cmd))
-        if subprocess.call(ssh_cmd, shell=True) != 0:
-            print('Failed to trigger upgrade (command: {}).'.format(ssh_cmd))
-        else:  # Hand control over to loads server.
-            if server.serve():  # Files were served to destination. We're done.
-                return 0
-            else:  # Destination failed to request anything from us.
-                print('No upgrade requests from {}!'.format(args.destination))
-        server.cleanup()
-        print('Falling back to old/--no-loads behavior...')
-
-    script = args.target.remote_script(
-        args.allow_test_software, sudo, args.install_args or '')
-    ssh_cmd = build_ssh_cmd(
-        remote_user, ssh_address(args.destination), script, ssh=args.target.ssh)
-
-    if args.via:
-        ssh_cmd = build_ssh_cmd(remote_user, ssh_address(args.via), ssh_cmd)
-
-    cat_cmd = 'cat'
-    if args.verbose:
-        if shutil.which('pv') is None:
-            print('WARNING: Install pv(1) to get file transfer progress!')
-        else:
-            cat_cmd = 'pv'
-            if image_path != Path('-'):
-                cat_cmd += ' --size={}'.format(image_path.stat().st_size)
 
-    cmd = '{} {} | {}'.format(cat_cmd, image_path, ssh_cmd)
     if args.verbose:
-        print('Running: {}'.format(ssh_cmd))
+        args.options.progress = show_progress
 
-    print('Connecting...')
-    subprocess.call(cmd, shell=True)
+    def push():
+        result = install(args.targets, args.destination, args.options)
+        for error in result.errors:
+            print(error)
+        return result
 
+    if not args.watch:
+        return 0 if push().ok else 1
+
+    # Push once, and then again whenever the image(s) are rebuilt. Start
+    # watching before the first push, so that rebuilds that finish while we
+    # are pushing are not missed.
+    import loadsutil
+    try:
+        image_paths = [args.file] if args.file else [
+            t.find_image(args.objdir) for t in args.targets]
+        checksums = [loadsutil.sha512sum(p) for p in image_paths]
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('Cannot find image(s) to watch: {}'.format(e))
+        return 1
+    watcher = loadsutil.watch(image_paths, settle=args.settle)
+    push()
+    try:
+        while True:
+            print('Watching {} for changes. Press Ctrl+C to stop.'.format(
+                ', '.join(str(p) for p in image_paths)))
+            next(watcher)
+            new_checksums = [loadsutil.sha512sum(p) for p in image_paths]
+            if new_checksums == checksums:
+                print('Image contents unchanged, nothing to push.')
+                continue
+            checksums = new_checksums
+            push()
+    except KeyboardInterrupt:
+        print('Stopped by user!')
     return 0
 
 
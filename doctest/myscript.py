@@ -2,9 +2,13 @@
 '''Calculate the square of a given number.'''
 
 import argparse
+from itertools import islice
 import sys
 
 
+CHUNK_SIZE = 64 * 1024  # numbers per chunk in batch()
+
+
 def calc(num, exp):
     '''Return 'num' raised to the power of 'exp'.
 
@@ -16,11 +20,39 @@ def calc(num, exp):
     return num ** exp
 
 
+def batch(infile, outfile, exp, chunk_size=CHUNK_SIZE):
+    '''Calculate results for the numbers (one per line) read from 'infile'.
+
+    Numbers are read and calculated in chunks of 'chunk_size', and the
+    results for each chunk are written to 'outfile' in one go.
+
+    >>> import io
+    >>> out = io.StringIO()
+    >>> batch(io.StringIO('0\\n1\\n\\n-2\\n3\\n'), out, 2, chunk_size=2)
+    >>> out.getvalue().split()
+    ['0', '1', '4', '9']
+    >>> out = io.StringIO()
+    >>> batch(io.StringIO('2\\n{}\\n'.format(2 ** 64)), out, 3)
+    >>> out.getvalue().split() == ['8', str(2 ** 192)]
+    True
+    '''
+    nums = (int(line) for line in infile if line.strip())
+    while True:
+        results = [calc(num, exp) for num in islice(nums, chunk_size)]
+        if not results:
+            break
+        outfile.write('\n'.join(map(str, results)) + '\n')
+
+
 def main():
     parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
     parser.add_argument(
-        'num', type=int,
+        'num', type=int, nargs='?',
         help='the number to be squared')
+    parser.add_argument(
+        '--batch', '-b', type=argparse.FileType('r'), metavar='INPUT',
+        help='calculate for each number (one per line) in INPUT ("-" for '
+             'stdin) instead')
     parser.add_argument(
         '--cube', '-3', action='store_true',
         help='calculate the cube (instead of square)')
@@ -29,8 +61,13 @@ def main():
         help='write result here (stdout by default)')
 
     args = parser.parse_args()
-    result = calc(args.num, 3 if args.cube else 2)
-    print(result, file=args.file)
+    if (args.num is None) == (args.batch is None):
+        parser.error('Must specify either <num> or --batch!')
+    exp = 3 if args.cube else 2
+    if args.batch:
+        batch(args.batch, args.file, exp)
+    else:
+        print(calc(args.num, exp), file=args.file)
 
 
 if __name__ == '__main__':
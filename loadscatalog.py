@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+'''Utility for indexing and querying large collections of loads directories.
+
+Walking a big tree of loads dirs (e.g. on a release share) and parsing every
+.loads file within is slow. This keeps an index of all .loads files (and the
+PKGs they reference) in a local SQLite database, which is updated
+incrementally by only rescanning directories whose mtime has changed.
+
+See https://rdwiki.cisco.com/wiki/Swupgrade for more details.
+'''
+
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import sys
+
+import loadsdir
+import loadsfile
+
+
+logger = logging.getLogger('loadscatalog')
+
+DEFAULT_DB_PATH = Path.home() / '.cache/loadscatalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS loads (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pkgs (
+    loads TEXT NOT NULL,
+    target TEXT,
+    product TEXT NOT NULL,
+    version TEXT NOT NULL,
+    version_fragment TEXT,
+    location TEXT NOT NULL,
+    checksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS loads_dir ON loads (dir);
+CREATE INDEX IF NOT EXISTS pkgs_loads ON pkgs (loads);
+CREATE INDEX IF NOT EXISTS pkgs_version ON pkgs (target, version_fragment);
+CREATE INDEX IF NOT EXISTS pkgs_checksum ON pkgs (checksum);
+'''
+
+
+class Catalog:
+    '''An index of .loads files stored in the SQLite database at 'db_path'.'''
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(db_path))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _forget_dir(self, path):
+        self.db.execute(
+            'DELETE FROM pkgs WHERE loads IN'
+            ' (SELECT path FROM loads WHERE dir = ?)', (path,))
+        self.db.execute('DELETE FROM loads WHERE dir = ?', (path,))
+        self.db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+
+    def _index_dir(self, path, mtime_ns, filenames):
+        # Reverse-map product name into target name
+        Products = {t.product: t.name for t in loadsfile.Targets.values()}
+
+        self._forget_dir(path)
+        self.db.execute('INSERT INTO dirs VALUES (?, ?)', (path, mtime_ns))
+        for name in filenames:
+            if not name.endswith('.loads') or name.endswith('.pkg.loads'):
+                continue  # not a .loads file, or just a .pkg.loads fragment
+            loads_path = os.path.join(path, name)
+            try:
+                loads = loadsfile.LoadsFile.parse(Path(loads_path))
+            except Exception as e:
+                logger.warning('Skipping {}: {!r}'.format(loads_path, e))
+                continue
+            self.db.execute(
+                'INSERT INTO loads VALUES (?, ?)', (loads_path, path))
+            for entry in loads:
+                try:
+                    fragment = loadsdir.version_as_path_fragment(
+                        entry['version'])
+                except (AssertionError, ValueError):
+                    fragment = None
+                self.db.execute(
+                    'INSERT INTO pkgs VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                        loads_path,
+                        Products.get(entry['product']),
+                        entry['product'],
+                        entry['version'],
+                        fragment,
+                        entry['packageLocation'],
+                        entry['checksum'],
+                    ))
+
+    def update(self, root):
+        '''Bring the index of .loads files found under 'root' up-to-date.
+
+        Only directories whose mtime has changed since the last update (or
+        that are new) are rescanned for .loads files. Note that editing a
+        .loads file in-place does not change its directory's mtime, whereas
+        the usual write + rename does.
+        Return the number of rescanned directories.
+        '''
+        root = str(root.resolve())
+        prefix = root.rstrip('/') + '/'
+        # Everything below 'root' sorts between 'root/' and 'root0' ('0' comes
+        # right after '/'). Unlike LIKE, this is case-sensitive and treats '_'
+        # and '%' in paths literally.
+        known = dict(self.db.execute(
+            'SELECT path, mtime_ns FROM dirs WHERE path = ? OR'
+            ' (path >= ? AND path < ?)', (root, prefix, prefix[:-1] + '0')))
+        rescanned = 0
+        with self.db:
+            for dirpath, _, filenames in os.walk(root):
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+                if known.pop(dirpath, None) != mtime_ns:
+                    logger.info('Indexing {}...'.format(dirpath))
+                    self._index_dir(dirpath, mtime_ns, filenames)
+                    rescanned += 1
+            for gone in known:  # not found anymore
+                logger.info('Forgetting {}...'.format(gone))
+                self._forget_dir(gone)
+        return rescanned
+
+    def find_version(self, target_name, version):
+        '''Yield paths of .loads files referencing the given target/version.
+
+        The 'version' may either be a path fragment (e.g. ce9_3_0-92f9c9ac866
+        or ce9.3.0-92f9c9ac866, see loadsdir.version_as_path_fragment()), or a
+        prefix of the version field in the .loads file.
+        '''
+        # Accept ce9_3_0-... too, as version_as_path_fragment() keeps the dots
+        release, sep, commit = version.partition('-')
+        fragment = release.replace('_', '.') + sep + commit
+        for row in self.db.execute(
+                'SELECT DISTINCT loads FROM pkgs WHERE target = ? AND'
+                ' (version_fragment = ? OR substr(version, 1, ?) = ?)'
+                ' ORDER BY loads',
+                (target_name, fragment, len(version), version)):
+            yield Path(row[0])
+
+    def find_checksum(self, checksum):
+        '''Yield (loads path, PKG location) of references to this checksum.'''
+        for loads, location in self.db.execute(
+                'SELECT loads, location FROM pkgs WHERE checksum = ?'
+                ' ORDER BY loads', (checksum,)):
+            yield Path(loads), location
+
+
+def main():
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument(
+        '--db', type=Path, default=DEFAULT_DB_PATH,
+        help='Catalog database (default: {})'.format(DEFAULT_DB_PATH))
+
+    subcommands = parser.add_subparsers(dest='subcommand')
+
+    cmd_update = subcommands.add_parser(
+        'update', help='Index new/changed .loads files under the given paths')
+    cmd_update.add_argument(
+        'roots', type=Path, nargs='+',
+        help='Directories to (re)index')
+
+    cmd_find = subcommands.add_parser(
+        'find', help='Find .loads files referencing a given PKG')
+    g = cmd_find.add_mutually_exclusive_group(required=True)
+    g.add_argument(
+        '--version', nargs=2, metavar=('TARGET', 'VERSION'),
+        help='Find by target and version (e.g. zenith ce9_3_0-92f9c9ac866)')
+    g.add_argument(
+        '--checksum',
+        help='Find by PKG checksum')
+
+    args = parser.parse_args()
+
+    if args.subcommand is None:
+        parser.print_help()
+        return 2
+
+    catalog = Catalog(args.db)
+    try:
+        if args.subcommand == 'update':
+            for root in args.roots:
+                rescanned = catalog.update(root)
+                print('Rescanned {} directories under {}'.format(
+                    rescanned, root))
+        elif args.version:
+            for path in catalog.find_version(*args.version):
+                print(path)
+        else:
+            for path, location in catalog.find_checksum(args.checksum):
+                print('{}: {}'.format(path, location))
+    finally:
+        catalog.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
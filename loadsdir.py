@@ -7,14 +7,28 @@ referenced from the .loads file.
 See https://rdwiki.cisco.com/wiki/Swupgrade for more details.
 '''
 
+import errno
+import fcntl
+import hashlib
 from http.server import SimpleHTTPRequestHandler
+import io
+import json
 import logging
+import os
 from pathlib import Path
 import re
+import stat
 import shutil
 from socketserver import ForkingTCPServer
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from urllib.error import URLError
+from urllib.parse import quote
+from urllib.request import urlopen
 
 import loadsfile
 import loadssign
@@ -48,8 +62,74 @@ def preferred_pkg_filename(target, pkg_version, suffix='.pkg'):
     return prefix + version_as_path_fragment(pkg_version) + suffix
 
 
+def preferred_loads_filename(codecs, pkg_version):
+    '''Return preferred .loads filename for the given codec targets + version.
+
+    A .loads file for a single codec is named like the codec's PKG file (see
+    preferred_pkg_filename()). A "super-loads" file that covers several codecs
+    is named by joining their (sorted) product names. Examples:
+        sunrise: s53200ce9_3_0-92f9c9ac866.loads
+        sunrise + zenith: s53200_s53300ce9_3_0-92f9c9ac866.loads
+    '''
+    assert codecs and all(t.is_codec for t in codecs)
+    if len(codecs) == 1:
+        return preferred_pkg_filename(codecs[0], pkg_version, '.loads')
+    prefix = '_'.join(sorted(t.product for t in codecs))
+    return prefix + version_as_path_fragment(pkg_version) + '.loads'
+
+
+def store_pkg(store, pkg, checksum):
+    '''Add the given 'pkg' to the content-addressed PKG 'store'.
+
+    PKGs in the store are named by their SHA512 'checksum' (as recorded in the
+    .loads files referencing them). If the store already has a PKG with the
+    same checksum, it is reused. Return path to the PKG inside the store.
+    '''
+    blob = store / checksum[:2] / checksum
+    if not blob.is_file():
+        logger.info('Adding {} to store {}'.format(pkg, store))
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name('{}.{}-{}.tmp'.format(
+            checksum, os.getpid(), threading.get_ident()))
+        loadsutil.copy_file(pkg, tmp)
+        tmp.chmod(0o444)  # Guard against modification through hardlinks
+        tmp.rename(blob)
+    return blob
+
+
+def link_from_store(blob, tgt):
+    '''Hardlink (or reflink/copy, across filesystems) 'blob' to 'tgt'.'''
+    try:
+        os.link(str(blob), str(tgt))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        loadsutil.copy_file(blob, tgt)
+
+
+def gc(store, loadsdirs):
+    '''Remove PKGs from 'store' that are no longer referenced.
+
+    A PKG in the store is kept if its checksum is referenced from a .loads
+    file found within any of the given 'loadsdirs', or if it is hardlinked from
+    somewhere else (e.g. a loads dir that was not given). Yield the paths of
+    the PKGs that were removed.
+    '''
+    referenced = set()
+    for loadsdir in loadsdirs:
+        for _, loads in walk(loadsdir):
+            referenced.update(entry['checksum'] for entry in loads)
+
+    for blob in sorted(store.glob('??/*')):
+        if blob.name in referenced or blob.stat().st_nlink > 1:
+            continue
+        logger.info('Removing unreferenced {}'.format(blob))
+        blob.unlink()
+        yield blob
+
+
 def build(dst, *, targets, pkgs, version=None, filenames=None,
-          loads_fname=None, test_signing_key=None, symlink=True):
+          loads_fname=None, test_signing_key=None, symlink=True, store=None):
     '''Store loads file + pkg symlinks for the given 'targets' within 'dst'.
 
     Write a .loads file inside 'dst' that references the given 'targets' and
@@ -59,7 +139,11 @@ def build(dst, *, targets, pkgs, version=None, filenames=None,
     of the .loads file and the .pkg symlinks/copies can be controlled with the
     'loads_fname' and 'filenames' arguments, respectively. When not given, they
     default to the filename organization that is expected inside a .cop release
-    file.
+    file. Several codecs may be given, in which case a "super-loads" file
+    covering all of them is written (see preferred_loads_filename()).
+    If 'store' is given, the PKGs are instead added to that content-addressed
+    PKG store (see store_pkg()), and hardlinked (or reflinked) from there into
+    'dst'. This overrides 'symlink'.
     Return path to the generated .loads file.
     '''
     assert dst.is_dir()
@@ -70,11 +154,20 @@ def build(dst, *, targets, pkgs, version=None, filenames=None,
     if filenames is None:
         filenames = [preferred_pkg_filename(t, version) for t in targets]
     if loads_fname is None:
-        loads_fname = preferred_pkg_filename(targets[0], version, '.loads')
+        codecs = [t for t in targets if t.is_codec]
+        if codecs:
+            loads_fname = preferred_loads_filename(codecs, version)
+        else:
+            loads_fname = preferred_pkg_filename(targets[0], version, '.loads')
 
     loads = loadsfile.LoadsFile()
     logger.info('Building loads dir at {} from these sources:'.format(dst))
     for target, pkg, fname in zip(targets, pkgs, filenames):
+        if not symlink and store is None:
+            # Copy first, so that the copy also provides the checksum
+            tgt = dst / fname
+            if not (tgt.exists() and tgt.samefile(pkg)):
+                loadsfile.pkg_info(target, pkg).copy_to(tgt)
         loads.add(target, pkg, fname)
         logger.info('{:>16}: {:32} -> {}'.format(str(target), fname, pkg))
 
@@ -88,14 +181,17 @@ def build(dst, *, targets, pkgs, version=None, filenames=None,
     # TODO: Add release signing
     loadssign.test_sign(loads_path, store=loads_path_sgn, key=test_signing_key)
 
-    # Symlink or copy all PKGs into dst to make them reachable from loads file
-    for fname, pkg in zip(filenames, pkgs):
+    # Symlink or link all PKGs into dst to make them reachable from loads file
+    # (copies were already made above).
+    for fname, pkg, entry in zip(filenames, pkgs, loads):
         tgt = dst / fname
+        if store is not None:
+            pkg = store_pkg(store, pkg, entry['checksum'])
         try:
-            if symlink:
+            if store is not None:
+                link_from_store(pkg, tgt)
+            elif symlink:
                 tgt.symlink_to(pkg)
-            else:
-                shutil.copy(pkg, tgt)
         except FileExistsError:
             if not tgt.samefile(pkg):
                 raise
@@ -133,6 +229,25 @@ def find_target_deps_and_pkgs(target, pkg=None, objdir=None):
         yield loadsfile.Targets[dep_name], find_pkg(dep_name, objdir)
 
 
+def find_targets_deps_and_pkgs(targets, pkgs=None, objdir=None):
+    '''Find dependencies and their PKG files for several targets at once.
+
+    This works like find_target_deps_and_pkgs() for each of the given
+    'targets' (with PKGs optionally overridden by the corresponding 'pkgs'
+    entries), except that dependencies shared by several targets (e.g. the
+    peripherals of sunrise and zenith) are only yielded once.
+    '''
+    if pkgs is None:
+        pkgs = [None] * len(targets)
+    assert len(targets) == len(pkgs)
+    seen = set()
+    for target, pkg in zip(targets, pkgs):
+        for t, p in find_target_deps_and_pkgs(target, pkg, objdir):
+            if t not in seen:
+                seen.add(t)
+                yield t, p
+
+
 def verify_pkgs(targets_and_pkgs):
     '''Verify that the PKGs in the given (target, pkg) tuples exist on disk.
 
@@ -171,13 +286,392 @@ def build_with_deps(dst, target, *, pkg=None, objdir=None, **kwargs):
     return build(dst, targets=targets, pkgs=pkgs, **kwargs)
 
 
-def http_server(loadsdir, address=('', 0), Server=ForkingTCPServer):
+def build_super_with_deps(dst, targets, *, pkgs=None, objdir=None, **kwargs):
+    '''Build a "super-loads" dir for several codec targets and their deps.
+
+    This works like build_with_deps(), except that the resulting loads dir
+    contains a single .loads file covering all the given codec 'targets'.
+    Peripheral PKGs that are shared between codecs are only referenced (and
+    stored, hashed and signed) once.
+    '''
+    assert all(t.is_codec for t in targets)
+    targets, pkgs = zip(
+        *verify_pkgs(find_targets_deps_and_pkgs(targets, pkgs, objdir)))
+    return build(dst, targets=targets, pkgs=pkgs, **kwargs)
+
+
+def watch(dst, targets, *, objdir=None, settle=2.0, **kwargs):
+    '''Keep loads dirs for the given 'targets' up-to-date as PKGs are rebuilt.
+
+    For each target, a loads dir including its dependencies is maintained at
+    dst/<target name>. Whenever one of their PKGs has been rewritten (and has
+    settled for 'settle' seconds), its .pkg.loads fragment is refreshed, and
+    the loads dirs that use it are rebuilt (and re-signed) by build() (with
+    any given 'kwargs'). Each rebuild happens in a new directory, which is
+    then atomically swapped into place by replacing the dst/<target name>
+    symlink. Previous generations are removed once nobody holds them (see
+    hold_loads_dir()). This function only returns when interrupted.
+    '''
+    deps = {t: list(find_target_deps_and_pkgs(t, None, objdir))
+            for t in targets}
+
+    def refresh(target):
+        try:
+            t_and_p = list(verify_pkgs(deps[target]))
+        except ValueError as e:
+            logger.warning('Cannot (yet) build {}: {}'.format(target, e))
+            return
+        link = dst / target.name
+        new = dst / '.{}.{}'.format(target.name, time.time_ns())
+        new.mkdir()
+        try:
+            loads_path = build(new, targets=[t for t, _ in t_and_p],
+                               pkgs=[p for _, p in t_and_p], **kwargs)
+        except Exception as e:  # keep watching, and retry on next change
+            logger.error('Failed to build {}: {!r}'.format(target, e))
+            shutil.rmtree(str(new))
+            return
+        tmp = dst / '.{}.link'.format(target.name)
+        try:  # left behind by an earlier crash
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        tmp.symlink_to(new.name)
+        tmp.rename(link)
+        logger.info('Updated {}'.format(link / loads_path.name))
+        remove_unused_generations(dst, target.name, keep=new)
+
+    for target in targets:
+        refresh(target)
+
+    users = {}  # PKG path -> targets whose loads dirs refer to it
+    for target, t_and_p in deps.items():
+        for t, pkg in t_and_p:
+            users.setdefault(pkg, []).append((target, t))
+
+    logger.info('Watching {} PKGs for changes...'.format(len(users)))
+    for changed in loadsutil.watch(list(users), settle=settle):
+        loadsfile.pkg_info.cache_clear()  # PKGs have changed under our feet
+        affected = []
+        for pkg in changed:
+            logger.info('{} has changed'.format(pkg))
+            for target, t in users[pkg]:
+                try:
+                    loadsfile.refresh_pkg_loads(t, pkg)
+                except subprocess.CalledProcessError as e:
+                    logger.error('Failed to inspect {}: {}'.format(pkg, e))
+                if target not in affected:
+                    affected.append(target)
+        for target in affected:
+            refresh(target)
+
+
+def hold_loads_dir(loads_dir):
+    '''Resolve a loads dir kept up-to-date by watch(), and hold on to it.
+
+    Return (path, fd), where 'path' is the current generation of 'loads_dir',
+    which watch() will not remove for as long as 'fd' is kept open.
+    '''
+    while True:
+        path = loads_dir.resolve()
+        try:
+            fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:  # just removed by watch(), look again
+            if not loads_dir.exists():
+                raise
+            continue
+        fcntl.flock(fd, fcntl.LOCK_SH)  # waits for any ongoing removal
+        if path.exists():
+            return path, fd
+        os.close(fd)
+
+
+def remove_unused_generations(dst, name, keep):
+    '''Remove the dst/.<name>.* loads dirs (but 'keep') that are not held.
+
+    Generations that are still held by hold_loads_dir() (e.g. while a device
+    is downloading from them) are left alone, and tried again next time.
+    '''
+    prefix = '.{}.'.format(name)
+    for path in dst.iterdir():
+        if (path == keep or not path.name.startswith(prefix) or
+                not path.name[len(prefix):].isdigit()):
+            continue
+        fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info('Keeping {} while it is in use'.format(path))
+        else:
+            shutil.rmtree(str(path))
+        finally:
+            os.close(fd)
+
+
+class TransferMetrics:
+    '''Account for the transfers made by a (forking) loads HTTP server.
+
+    Every transfer appends a line to a shared log file when it starts, and
+    another when it finishes, so that the numbers can be aggregated across the
+    forked processes serving the requests. Each line is a single O_APPEND
+    write, and thus not interleaved with lines from other processes.
+    '''
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='loadsdir-', suffix='.log')
+        os.close(fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.final = None
+
+    def close(self):
+        if self.fd is not None:
+            self.final = self.summary()  # still available after closing
+            os.close(self.fd)
+            os.unlink(self.path)
+            self.fd = None
+
+    def record(self, **event):
+        os.write(self.fd, (json.dumps(event) + '\n').encode('utf8'))
+
+    def summary(self):
+        '''Aggregate the transfers logged so far into a dict of metrics.'''
+        if self.fd is None:
+            return self.final
+        ret = {
+            'active': 0, 'completed': 0, 'aborted': 0, 'bytes': 0,
+            'ttfb': 0.0, 'ttfb_max': 0.0, 'duration': 0.0,
+            'read_time': 0.0, 'write_time': 0.0, 'clients': {},
+        }
+        with open(self.path) as f:
+            for line in f:
+                event = json.loads(line)
+                if event['status'] == 'started':
+                    ret['active'] += 1
+                    continue
+                ret['active'] -= 1
+                ret[event['status']] += 1
+                ret['bytes'] += event['bytes']
+                ret['ttfb'] += event['ttfb']
+                ret['ttfb_max'] = max(ret['ttfb_max'], event['ttfb'])
+                ret['duration'] += event['duration']
+                ret['read_time'] += event['read_time']
+                ret['write_time'] += event['write_time']
+                client = ret['clients'].setdefault(
+                    event['client'], {'bytes': 0, 'duration': 0.0})
+                client['bytes'] += event['bytes']
+                client['duration'] += event['duration']
+        return ret
+
+    def prometheus(self):
+        '''Return the current metrics in Prometheus' text format.'''
+        m = self.summary()
+        done = m['completed'] + m['aborted']
+        lines = [
+            '# HELP loadsdir_bytes_served_total Bytes sent by finished '
+            'transfers.',
+            '# TYPE loadsdir_bytes_served_total counter',
+            'loadsdir_bytes_served_total {}'.format(m['bytes']),
+            '# HELP loadsdir_transfers_active Transfers in progress.',
+            '# TYPE loadsdir_transfers_active gauge',
+            'loadsdir_transfers_active {}'.format(m['active']),
+            '# HELP loadsdir_transfers_total Finished transfers.',
+            '# TYPE loadsdir_transfers_total counter',
+            'loadsdir_transfers_total{{status="completed"}} {}'.format(
+                m['completed']),
+            'loadsdir_transfers_total{{status="aborted"}} {}'.format(
+                m['aborted']),
+            '# HELP loadsdir_ttfb_seconds Time from request to first byte.',
+            '# TYPE loadsdir_ttfb_seconds summary',
+            'loadsdir_ttfb_seconds_sum {:.6f}'.format(m['ttfb']),
+            'loadsdir_ttfb_seconds_count {}'.format(done),
+            '# HELP loadsdir_transfer_seconds Duration of transfers.',
+            '# TYPE loadsdir_transfer_seconds summary',
+            'loadsdir_transfer_seconds_sum {:.6f}'.format(m['duration']),
+            'loadsdir_transfer_seconds_count {}'.format(done),
+            '# HELP loadsdir_read_seconds_total Time spent reading files.',
+            '# TYPE loadsdir_read_seconds_total counter',
+            'loadsdir_read_seconds_total {:.6f}'.format(m['read_time']),
+            '# HELP loadsdir_write_seconds_total Time spent sending to '
+            'clients.',
+            '# TYPE loadsdir_write_seconds_total counter',
+            'loadsdir_write_seconds_total {:.6f}'.format(m['write_time']),
+            '# HELP loadsdir_client_bytes_total Bytes sent per client.',
+            '# TYPE loadsdir_client_bytes_total counter',
+        ]
+        for client, c in sorted(m['clients'].items()):
+            lines.append(
+                'loadsdir_client_bytes_total{{client="{}"}} {}'.format(
+                    client, c['bytes']))
+        lines += [
+            '# HELP loadsdir_client_throughput_bytes Average throughput per '
+            'client (bytes/sec).',
+            '# TYPE loadsdir_client_throughput_bytes gauge',
+        ]
+        for client, c in sorted(m['clients'].items()):
+            lines.append(
+                'loadsdir_client_throughput_bytes{{client="{}"}} {:.0f}'
+                .format(client, c['bytes'] / max(c['duration'], 1e-6)))
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        m = self.summary()
+        logger.info(
+            'Served {} transfers ({} completed, {} aborted, {} active), '
+            '{:.1f} MiB in total'.format(
+                m['completed'] + m['aborted'], m['completed'], m['aborted'],
+                m['active'], m['bytes'] / (1024 * 1024)))
+        if m['completed'] + m['aborted']:
+            logger.info(
+                'Time to first byte: {:.3f}s average, {:.3f}s max; time spent '
+                'reading files: {:.1f}s, sending to clients: {:.1f}s'.format(
+                    m['ttfb'] / (m['completed'] + m['aborted']),
+                    m['ttfb_max'], m['read_time'], m['write_time']))
+        for client, c in sorted(m['clients'].items()):
+            logger.info('  {}: {:.1f} MiB at {:.1f} MiB/s'.format(
+                client, c['bytes'] / (1024 * 1024),
+                c['bytes'] / max(c['duration'], 1e-6) / (1024 * 1024)))
+
+
+class Mirror:
+    '''Pull-through cache of the loads dirs found at the 'upstream' URL.
+
+    Files are fetched from upstream into the 'cache' directory on demand (see
+    .fetch()), from where they are then served. .loads files (and signatures)
+    are refetched on every request, to pick up changes upstream. PKG files are
+    fetched once, and only served (and cached) after they have been verified
+    against the checksum from a (cached) .loads file that references them.
+    The least recently used PKGs are evicted to keep the cache below
+    'max_size' bytes.
+
+    Fetches are serialized per file with flock(), so that concurrent requests
+    (from forked request handlers) for the same PKG share a single fetch.
+    '''
+
+    def __init__(self, cache, upstream, max_size):
+        self.cache = cache
+        self.upstream = upstream.rstrip('/') + '/'
+        self.max_size = max_size
+        self.locks = cache / '.locks'
+        self.locks.mkdir(parents=True, exist_ok=True)
+
+    def _lock(self, rel_path):
+        name = str(rel_path).replace('/', '%') + '.lock'
+        lock = (self.locks / name).open('w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock  # released when closed
+
+    def _download(self, rel_path):
+        '''Download 'rel_path' from upstream, return (tmp path, checksum).'''
+        url = self.upstream + quote(str(rel_path))
+        tmp = self.cache / (str(rel_path) + '.tmp')
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        logger.info('Fetching {}...'.format(url))
+        with urlopen(url, timeout=60) as src, tmp.open('wb') as dst:
+            checksum = loadsutil.copy_and_sha512sum(src, dst)
+        return tmp, checksum
+
+    def known_checksum(self, rel_path):
+        '''Return the checksum of 'rel_path' from the cached .loads files.
+
+        PKG locations in .loads files are either relative to the .loads file,
+        or absolute URLs, which we recognize if they point into upstream.
+        Return None if no cached .loads file references 'rel_path'.
+        '''
+        for loads_path in self.cache.rglob('*.loads'):
+            if loads_path.name.endswith('.pkg.loads'):
+                continue
+            try:
+                loads = loadsfile.LoadsFile.parse(loads_path)
+            except (AssertionError, ValueError) as e:
+                logger.warning('Ignoring {}: {}'.format(loads_path, e))
+                continue
+            base = loads_path.parent.relative_to(self.cache)
+            for entry in loads:
+                location = entry['packageLocation']
+                if location.startswith(self.upstream):
+                    location = location[len(self.upstream):]
+                elif '://' in location:
+                    continue  # served from elsewhere
+                if os.path.normpath(str(base / location)) == str(rel_path):
+                    return entry['checksum']
+        return None
+
+    def evict(self, keep):
+        '''Remove least recently used PKGs until the cache fits max_size.'''
+        with self._lock('.evict'):
+            pkgs = []
+            for path in self.cache.rglob('*'):
+                if (self.locks in path.parents or path.suffix in {
+                        '.loads', '.sgn', '.tmp'} or not path.is_file()):
+                    continue
+                st = path.stat()
+                pkgs.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in pkgs)
+            for _, size, path in sorted(pkgs):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                logger.info('Evicting {} from cache'.format(path))
+                path.unlink()
+                total -= size
+
+    def fetch(self, rel_path):
+        '''Make sure 'rel_path' is available in the cache, if possible.'''
+        path = self.cache / rel_path
+        if self.locks in path.parents:
+            return
+        is_loads = path.suffix in {'.loads', '.sgn'}
+        if path.is_file() and not is_loads:
+            os.utime(str(path))  # mark as recently used
+            return
+        with self._lock(rel_path):
+            if path.is_file() and not is_loads:
+                return  # fetched by a concurrent request while we waited
+            try:
+                tmp, checksum = self._download(rel_path)
+            except (URLError, OSError) as e:
+                logger.error('Failed to fetch {} from upstream: {}'.format(
+                    rel_path, e))
+                return  # serve what we have (if anything)
+            if not is_loads:
+                expected = self.known_checksum(rel_path)
+                if expected is None:
+                    logger.warning('No .loads file references {}, refusing to '
+                                   'serve it'.format(rel_path))
+                    tmp.unlink()
+                    return
+                if checksum != expected:
+                    logger.error('Checksum mismatch for {} from upstream, '
+                                 'refusing to serve it'.format(rel_path))
+                    tmp.unlink()
+                    return
+            tmp.rename(path)
+        if not is_loads:
+            self.evict(keep=path)
+
+
+def http_server(loadsdir, address=('', 0), Server=ForkingTCPServer,
+                mirror=None):
     '''Return a HTTP server instance serving the contents of 'loadsdir'.
 
     The server will be listening on the given address (host, port) tuple.
     If port is 0 (the default), the port number is chosen automatically, and
     can be retrieved from .server_address[1] on the returned server instance.
+
+    Transfers are accounted for in the server's .metrics (a TransferMetrics
+    instance), which are also available from the server under /metrics, and
+    summarized in the log when the server is closed.
+
+    If a 'mirror' (a Mirror instance caching into 'loadsdir') is given,
+    requested files are fetched from its upstream server before serving them.
+
+    If 'loadsdir' is an (uncompressed) tar archive instead of a directory, its
+    members are served directly from the archive with sendfile(), using a
+    TarIndex built once, up front. Range requests are supported for these.
     '''
+    archive = TarIndex(loadsdir) if loadsdir.is_file() else None
+
     class LoadsRequestHandler(SimpleHTTPRequestHandler):
         server_version = 'loadsdir.py/1'
         extensions_map = {'': 'application/octet-stream'}
@@ -190,34 +684,193 @@ def http_server(loadsdir, address=('', 0), Server=ForkingTCPServer):
         def log_request(self, *args):
             pass  # Silence SimpleHTTPRequestHandler's default request logging
 
+        def send_metrics(self):
+            body = self.server.metrics.prometheus().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
         def do_GET(self):
             """Serve a GET request."""
-            # Provide out own request logging instead, that logs both when
-            # we start and finish serving files.
+            if self.path == '/metrics':
+                return self.send_metrics()
+            if mirror is not None:
+                rel = Path(self.translate_path(self.path)).relative_to(
+                    loadsdir)
+                if rel.parts:
+                    mirror.fetch(rel)
+            start = time.monotonic()
+            if archive is not None:
+                head = self.send_member_head()
+                if head:
+                    path, offset, count = head
+                    self.transfer(path, start, lambda: self.sendfile_timed(
+                        offset, count, start))
+                return
             f = self.send_head()
             if f:
-                path = Path(f.name).relative_to(loadsdir)
-                logger.info('  << Requested: {}...'.format(path))
                 try:
-                    self.copyfile(f, self.wfile)
+                    self.transfer(
+                        Path(f.name).relative_to(loadsdir), start,
+                        lambda: self.copy_timed(f, start))
                 finally:
                     f.close()
-                    logger.info('  >> Responded: {}'.format(path))
 
-    ret = Server(address, LoadsRequestHandler)
+        def do_HEAD(self):
+            """Serve a HEAD request."""
+            if archive is not None:
+                self.send_member_head()
+                return
+            super().do_HEAD()
+
+        def transfer(self, path, start, copy):
+            '''Send the body of 'path' with 'copy', and account for it.'''
+            # Provide out own request logging instead, that logs both when
+            # we start and finish serving files.
+            client = self.client_address[0]
+            logger.info('  << Requested: {} by {}...'.format(path, client))
+            transfer = '{}-{}-{}'.format(
+                os.getpid(), threading.get_ident(), start)
+            self.server.metrics.record(id=transfer, status='started')
+            status, sent, ttfb, read_time, write_time = copy()
+            duration = time.monotonic() - start
+            self.server.metrics.record(
+                id=transfer, status=status, client=client, path=str(path),
+                bytes=sent, ttfb=ttfb, duration=duration,
+                read_time=read_time, write_time=write_time)
+            logger.info('  >> Responded: {} to {} ({}, {} bytes in '
+                        '{:.1f}s)'.format(
+                            path, client, status, sent, duration))
+
+        def send_member_head(self):
+            '''Like .send_head(), for a member of the archive.
+
+            Honor a single byte range in a Range header. Return the member's
+            path (relative to the archive), and the offset and size of the
+            data to send from the archive, or None if there is nothing to send.
+            '''
+            path = Path(self.translate_path(self.path))
+            try:
+                offset, size = archive.range(path)
+            except FileNotFoundError:
+                self.send_error(404, 'File not found')
+                return None
+            first, last = 0, size - 1
+            requested = self.headers.get('Range')
+            if requested is not None:
+                m = re.fullmatch(r'bytes=(\d*)-(\d*)', requested.strip())
+                if m is None or m.groups() == ('', ''):
+                    pass  # ignore malformed or multiple ranges
+                elif m.group(1) == '':  # the last N bytes
+                    first = max(size - int(m.group(2)), 0)
+                else:
+                    first = int(m.group(1))
+                    if m.group(2) != '':
+                        last = min(int(m.group(2)), size - 1)
+                if first > last:
+                    self.send_response(416)
+                    self.send_header(
+                        'Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+            partial = (first, last) != (0, size - 1)
+            self.send_response(206 if partial else 200)
+            self.send_header('Content-Type', self.guess_type(str(path)))
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if partial:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    first, last, size))
+            self.end_headers()
+            return path.relative_to(loadsdir), offset + first, last - first + 1
+
+        def sendfile_timed(self, offset, count, start):
+            '''Send 'count' bytes at 'offset' in the archive to the client.'''
+            sent, ttfb = 0, None
+            fd = os.open(str(loadsdir), os.O_RDONLY)
+            t0 = time.monotonic()
+            try:
+                while sent < count:
+                    n = os.sendfile(self.connection.fileno(), fd,
+                                    offset + sent, count - sent)
+                    if n == 0:  # archive truncated under our feet?
+                        break
+                    if ttfb is None:
+                        ttfb = time.monotonic() - start
+                    sent += n
+                status = 'completed' if sent == count else 'aborted'
+            except ConnectionError as e:
+                logger.warning('Transfer to {} aborted: {}'.format(
+                    self.client_address[0], e))
+                status = 'aborted'
+            finally:
+                os.close(fd)
+            t1 = time.monotonic()
+            ttfb = t1 - start if ttfb is None else ttfb
+            # sendfile() reads and sends within the kernel, count it as sending
+            return status, sent, ttfb, 0.0, t1 - t0
+
+        def copy_timed(self, f, start):
+            '''Like .copyfile(), but time reading vs. sending to client.'''
+            sent, ttfb, read_time, write_time = 0, None, 0.0, 0.0
+            try:
+                while True:
+                    t0 = time.monotonic()
+                    chunk = f.read(loadsutil.READ_SIZE)
+                    t1 = time.monotonic()
+                    read_time += t1 - t0
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    t2 = time.monotonic()
+                    write_time += t2 - t1
+                    if ttfb is None:
+                        ttfb = t2 - start
+                    sent += len(chunk)
+                status = 'completed'
+            except ConnectionError as e:
+                logger.warning('Transfer to {} aborted: {}'.format(
+                    self.client_address[0], e))
+                status = 'aborted'
+            ttfb = time.monotonic() - start if ttfb is None else ttfb
+            return status, sent, ttfb, read_time, write_time
+
+    class MetricsServer(Server):
+        def server_close(self):
+            super().server_close()  # also waits for forked children
+            if self.metrics.fd is not None:
+                self.metrics.log_summary()
+                self.metrics.close()
+
+    ret = MetricsServer(address, LoadsRequestHandler)
+    ret.metrics = TransferMetrics()
     logger.info('Serving {} over port {}...'.format(
         loadsdir, ret.server_address[1]))
     return ret
 
 
-def walk(loadsdir):
+def walk(loadsdir, index=None):
     '''Find .loads files under 'loadsdir'.
 
     For each .loads file found, yield its path and the corresponding
-    loadsfile.LoadsFile instance.
+    loadsfile.LoadsFile instance. If an index of 'loadsdir' is given (see
+    open_index()), find the .loads files there, instead of traversing
+    'loadsdir' again.
     '''
-    for path in loadsdir.rglob('*.loads'):
-        yield path, loadsfile.LoadsFile.parse(path)
+    if index is None:
+        paths = loadsdir.rglob('*.loads')
+    else:
+        paths = index.find('.loads')
+    for path in paths:
+        if index is None:
+            loads = loadsfile.LoadsFile.parse(path)
+        else:
+            with index.open(path) as f:
+                loads = loadsfile.LoadsFile.load(f)
+        yield path, loads
 
 
 def loads_targets_and_pkgs(loadsdir):
@@ -246,6 +899,100 @@ def loads_targets_and_pkgs(loadsdir):
         yield lp.relative_to(loadsdir), [target_and_pkg(e) for e in lf]
 
 
+class HashingReader:
+    '''Wrap a file object, and hash all data that is read from it.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha512()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def export(loadsdir, out):
+    '''Write the loads dir at 'loadsdir' into a tar archive at 'out'.
+
+    The .loads files found in 'loadsdir', their signatures, and the PKGs they
+    reference are streamed into the archive (symlinks are followed, and the
+    files they point to are stored in their place), with paths relative to
+    'loadsdir'. If 'out' ends with .zst, the archive is compressed by piping
+    it through zstd(1). Each file is read only once: PKGs are checked against
+    their checksums from the .loads file while they are being archived, and a
+    SHA512SUMS manifest of all archived files is appended to the archive.
+    If any PKG fails its check (or zstd is missing), ValueError is raised.
+    On any failure, no (partial) archive is left at 'out'.
+    Return the list of (checksum, path) entries in the manifest.
+    '''
+    members = {}  # relative path -> expected checksum (or None)
+    for loads_path, loads in sorted(walk(loadsdir), key=lambda t: t[0]):
+        members[loads_path.relative_to(loadsdir)] = None
+        sgn_path = loads_path.with_suffix('.loads.sgn')
+        if sgn_path.is_file():
+            members[sgn_path.relative_to(loadsdir)] = None
+        for entry in loads:
+            pkg_path = Path(os.path.normpath(
+                str(loads_path.parent / entry['packageLocation'])))
+            members.setdefault(
+                pkg_path.relative_to(loadsdir), entry['checksum'])
+
+    zstd = None
+    if out.suffix == '.zst':
+        try:
+            zstd = subprocess.Popen(
+                ['zstd', '-q', '-f', '-T0', '-o', str(out)],
+                stdin=subprocess.PIPE, bufsize=loadsutil.READ_SIZE)
+        except FileNotFoundError:
+            raise ValueError('Cannot export {}: zstd is not installed'.format(
+                out)) from None
+        f = zstd.stdin
+    else:
+        f = out.open('wb', buffering=loadsutil.READ_SIZE)
+
+    manifest, errors = [], []
+    try:
+        try:
+            with tarfile.open(fileobj=f, mode='w|',
+                              bufsize=loadsutil.READ_SIZE,
+                              copybufsize=loadsutil.READ_SIZE) as tar:
+                for rel_path, expected in members.items():
+                    path = loadsdir / rel_path
+                    logger.info('Exporting {}...'.format(rel_path))
+                    with path.open('rb') as src:  # follows symlinks
+                        info = tar.gettarinfo(
+                            arcname=str(rel_path), fileobj=src)
+                        reader = HashingReader(src)
+                        tar.addfile(info, reader)
+                    checksum = reader.hash.hexdigest()
+                    if expected is not None and checksum != expected:
+                        errors.append('{}: checksum mismatch'.format(rel_path))
+                    manifest.append((checksum, str(rel_path)))
+
+                data = ''.join(
+                    '{}  {}\n'.format(*m) for m in manifest).encode()
+                info = tarfile.TarInfo('SHA512SUMS')
+                info.size, info.mode = len(data), 0o644
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(data))
+        finally:
+            try:
+                f.close()
+            finally:
+                if zstd is not None and zstd.wait() != 0:
+                    errors.append('zstd failed with exit code {}'.format(
+                        zstd.returncode))
+        if errors:
+            raise ValueError('Failed to export {}: {}'.format(
+                loadsdir, ', '.join(errors)))
+    except BaseException:  # do not leave a truncated archive behind
+        if out.exists():
+            out.unlink()
+        raise
+    return manifest
+
+
 class ValidationError(Exception):
     def __init__(self, check, context, msg):
         self.check = check
@@ -256,7 +1003,279 @@ class ValidationError(Exception):
         return 'Failed check {0.check} in {0.context}: {0.msg}'.format(self)
 
 
-def validate(loadsdir, ticket=None, **kwargs):
+class FsIndex:
+    '''In-memory index of everything within 'root', from a single traversal.
+
+    For each entry, we record its lstat() and stat() results, its symlink
+    target (if any), and its resolved path. Symlinks are not followed into
+    other directories. Questions about paths within 'root' are then answered
+    from the index, without more system calls (which are expensive on network
+    filesystems). Other paths (e.g. outside 'root') are passed on to the
+    filesystem.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.real_root = Path(os.path.realpath(str(root)))
+        self.entries = {}  # path -> (lstat, symlink target, stat, resolved)
+        self._scan(root, self.real_root)
+
+    def _scan(self, path, resolved):
+        with os.scandir(str(path)) as it:
+            for de in it:
+                lst = de.stat(follow_symlinks=False)
+                if de.is_symlink():
+                    link = os.readlink(de.path)
+                    real = Path(os.path.realpath(de.path))
+                    try:
+                        st = de.stat()
+                    except OSError:  # dangling symlink
+                        st = None
+                else:
+                    link, real, st = None, resolved / de.name, lst
+                self.entries[path / de.name] = (lst, link, st, real)
+                if stat.S_ISDIR(lst.st_mode):
+                    self._scan(path / de.name, real)
+
+    def _lookup(self, path):
+        if '..' in path.parts:  # cannot normalize without the filesystem
+            return None
+        return self.entries.get(Path(os.path.normpath(str(path))))
+
+    def find(self, suffix):
+        '''Yield indexed paths with the given filename suffix.'''
+        for path in self.entries:
+            if path.name.endswith(suffix):
+                yield path
+
+    def is_file(self, path):
+        entry = self._lookup(path)
+        if entry is None:
+            return path.is_file()
+        st = entry[2]
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def resolve(self, path):
+        if path == self.root:
+            return self.real_root
+        entry = self._lookup(path)
+        return path.resolve() if entry is None else entry[3]
+
+    def fingerprint(self, path):
+        entry = self._lookup(path)
+        if entry is None:
+            return stat_fingerprint(path)
+        return _fingerprint(*entry[:3])
+
+    def open(self, path):
+        return path.open('rb')
+
+    def local(self, path):
+        '''Return a filesystem path with the contents of 'path'.'''
+        return path
+
+    def pkg_file(self, path):
+        return loadsfile.PkgFile(path)
+
+
+class ArchivedPkg:
+    '''Like loadsfile.PkgFile, for a PKG stored within an archive.
+
+    pkgextract needs the PKG as a file of its own, so the version and targets
+    are not available (None) here. The checksum is computed from the PKG data
+    within the archive.
+    '''
+    version = None
+    targets = None
+
+    def __init__(self, archive, offset, size):
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+
+    @property
+    def checksum(self):
+        return loadsutil.sha512sum(self.archive, self.size, self.offset)
+
+
+class TarIndex:
+    '''Index of the members of the (uncompressed) tar archive at 'root'.
+
+    The archive is treated like a loads dir, i.e. 'root'/some/file refers to
+    the some/file member of the archive. The archive is scanned once, and the
+    offset and size of each member's data within the archive is recorded, so
+    that it can be read (or served) directly from the archive, instead of
+    extracting it first. Symlinks between members are resolved within the
+    archive. This otherwise answers the same questions as an FsIndex.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.real_root = root
+        self.stat = root.stat()
+        self.members = {}  # path -> tarfile.TarInfo
+        self._tmpdir = None
+        with tarfile.open(str(root), 'r:') as tar:
+            for info in tar:
+                self.members[root / os.path.normpath(info.name)] = info
+
+    def find(self, suffix):
+        '''Yield paths of archive members with the given filename suffix.'''
+        for path, info in self.members.items():
+            if path.name.endswith(suffix) and not info.isdir():
+                yield path
+
+    def resolve(self, path):
+        path = Path(os.path.normpath(str(path)))
+        for _ in range(40):  # like the kernel's limit on nested symlinks
+            info = self.members.get(path)
+            if info is None or not (info.issym() or info.islnk()):
+                return path
+            if info.islnk():  # hardlink, relative to the archive root
+                path = self.root / os.path.normpath(info.linkname)
+            else:
+                path = Path(os.path.normpath(str(
+                    path.parent / info.linkname)))
+        return path
+
+    def _member(self, path):
+        info = self.members.get(self.resolve(path))
+        if info is None or not info.isfile():
+            raise FileNotFoundError('{} not found in archive'.format(path))
+        return info
+
+    def is_file(self, path):
+        if self.root not in path.parents:
+            return path.is_file()
+        try:
+            self._member(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def range(self, path):
+        '''Return (offset, size) of the data for 'path' within the archive.'''
+        info = self._member(path)
+        return info.offset_data, info.size
+
+    def fingerprint(self, path):
+        try:
+            info = self._member(path)
+        except FileNotFoundError:
+            return None
+        return [self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns,
+                info.offset_data, info.size]
+
+    def open(self, path):
+        offset, size = self.range(path)
+        with self.root.open('rb') as f:
+            f.seek(offset)
+            return io.BytesIO(f.read(size))  # only used for small files
+
+    def local(self, path):
+        '''Return a filesystem path with the contents of 'path'.
+
+        The member is extracted into a temporary directory, which is removed
+        along with this index. Only use this for small files.
+        '''
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.TemporaryDirectory()
+        local = Path(self._tmpdir.name) / path.relative_to(self.root)
+        local.parent.mkdir(parents=True, exist_ok=True)
+        with self.open(path) as src, local.open('wb') as dst:
+            shutil.copyfileobj(src, dst)
+        return local
+
+    def pkg_file(self, path):
+        return ArchivedPkg(self.root, *self.range(path))
+
+
+def open_index(loadsdir):
+    '''Return a TarIndex or FsIndex for the tar archive/directory given.'''
+    return TarIndex(loadsdir) if loadsdir.is_file() else FsIndex(loadsdir)
+
+
+def _fingerprint(lst, link, st):
+    def summary(st):
+        return None if st is None else [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    if lst is None:
+        return None
+    elif link is None:
+        return summary(lst)
+    else:
+        return summary(lst) + [link, summary(st)]
+
+
+def stat_fingerprint(path):
+    '''Summarize the stat() results for 'path' into a JSON-compatible list.
+
+    Both the path itself and (if it is a symlink) the file it points to are
+    included, so that the fingerprint changes when either of them changes.
+    Missing files are represented by None.
+    '''
+    try:
+        lst = path.lstat()
+    except OSError:
+        return None
+    if not stat.S_ISLNK(lst.st_mode):
+        return _fingerprint(lst, None, lst)
+    try:
+        st = path.stat()
+    except OSError:
+        st = None
+    return _fingerprint(lst, os.readlink(str(path)), st)
+
+
+class ValidationState:
+    '''Results from a previous validate() run, kept in a JSON file at 'path'.
+
+    For each .loads file, we store the stat fingerprints of its inputs (the
+    .loads file itself, its signature, and its referenced PKGs), together with
+    the errors found by the checks. Results are only reused if the same checks
+    (and the same SWIMS ticket) were used in the previous run.
+    '''
+
+    def __init__(self, path, checks, ticket=None):
+        self.path = path
+        self.config = {
+            'checks': {k: bool(v) for k, v in checks.items()},
+            'ticket': None if ticket is None else stat_fingerprint(ticket),
+        }
+        self.previous = {}
+        self.results = {}
+        if path is not None and path.is_file():
+            with path.open() as f:
+                state = json.load(f)
+            if state.get('config') == self.config:
+                self.previous = state['results']
+
+    def lookup(self, loads_path, inputs):
+        '''Return list of earlier errors for 'loads_path', or None.'''
+        result = self.previous.get(str(loads_path))
+        if result is None or result['inputs'] != inputs:
+            return None
+        self.results[str(loads_path)] = result
+        return [ValidationError(check, Path(context), msg)
+                for check, context, msg in result['errors']]
+
+    def store(self, loads_path, inputs, errors):
+        self.results[str(loads_path)] = {
+            'inputs': inputs,
+            'errors': [[e.check, str(e.context), e.msg] for e in errors],
+        }
+
+    def save(self):
+        '''Write results for the .loads files validated in this run.'''
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            json.dump({'config': self.config, 'results': self.results}, f)
+        tmp.rename(self.path)
+
+
+def validate(loadsdir, ticket=None, state=None, **kwargs):
     '''Perform various validity checks on the given 'loadsdir'.
 
     Each check is enabled/disabled by a corresponding boolean/flag keyword
@@ -285,6 +1304,19 @@ def validate(loadsdir, ticket=None, **kwargs):
     In order to verify release-signed .loads files, the 'loads_signed' check
     must be enable, AND 'ticket' must point to a valid SWIMS ticket file.
 
+    The 'loadsdir' may also be an uncompressed tar archive (see TarIndex).
+    The pkg_version and pkg_targets checks are then skipped, as pkgextract
+    cannot inspect PKGs within an archive.
+
+    The cheap checks are performed for all .loads files before the expensive
+    ones, and PKGs referenced from several .loads files are only inspected
+    once.
+
+    If 'state' is given, it names a file where the results of this validation
+    are stored (see ValidationState). In subsequent runs, .loads files whose
+    inputs have not changed since then are not checked again; their earlier
+    errors are yielded instead.
+
     Each failed check is _yielded_ (NOT raised) as a ValidationError instance.
     This allows a caller to iterate over the generated errors, and potentially
     abort the validation on the first (or any) error.
@@ -306,112 +1338,189 @@ def validate(loadsdir, ticket=None, **kwargs):
         'pkg_checksum': True,
     }
     checks.update(kwargs)
+    state = ValidationState(state, checks, ticket)
 
-    # Reverse-map product names into targets
-    Products = {t.product: t for t in loadsfile.Targets.values()}
-
+    # First, plan the work: Find all .loads files, and yield the results from
+    # those that are unchanged since the last run right away. Then, perform
+    # the remaining checks in order of increasing cost (structure, signatures,
+    # PKG headers, PKG contents), so that failing early is cheap.
+    index = open_index(loadsdir)
     seen_pkgs = set()
-    for loads_path, loads in walk(loadsdir):
-        codecs, peripherals = [], []
-        for entry in loads:
-            pkg_ref = Path(entry['packageLocation'])
-
-            if checks['pkg_relative']:
-                if pkg_ref.is_absolute() or '://' in str(pkg_ref):
-                    yield ValidationError('pkg_relative', loads_path,
-                        '{} is absolute filename or URL'.format(pkg_ref))
-            pkg_path = loads_path.parent / pkg_ref
-            if checks['pkg_inside']:
-                if loadsdir not in pkg_path.parents:
-                    yield ValidationError('pkg_inside', loads_path,
-                        '{} is not within {}'.format(pkg_path, loadsdir))
-            if checks['pkg_exists']:
-                if not pkg_path.is_file():
-                    yield ValidationError('pkg_exists', loads_path,
-                        '{} does not exist as a file'.format(pkg_path))
-            if checks['pkg_external_symlinks']:
-                if loadsdir.resolve() not in pkg_path.resolve().parents:
-                    yield ValidationError('pkg_external_symlinks', loads_path,
-                        '{} points outside {}'.format(pkg_path, loadsdir))
-            seen_pkgs.add(pkg_path.resolve())
-
-            try:
-                target = Products[entry['product']]
-            except KeyError:
-                if checks['product_exists']:
-                    yield ValidationError('product_exists', loads_path,
-                        '{} is not a product name'.format(entry['product']))
-                else:
-                    continue
-
-            if target.is_codec:
-                codecs.append((target, pkg_path.name, entry['version']))
-            else:
-                peripherals.append((target, pkg_path.name))
+    pending = []  # (loads_path, loads, inputs) for .loads files to check
+    errors = {}  # loads_path -> list of errors, for storing into state
+    try:
+        for loads_path, loads in walk(loadsdir, index):
+            pkg_paths = [loads_path.parent / entry['packageLocation']
+                         for entry in loads]
+            seen_pkgs.update(index.resolve(pkg_path) for pkg_path in pkg_paths)
 
-            try:
-                pkg = loadsfile.PkgFile(pkg_path)
-                if checks['pkg_version']:
-                    if entry['version'] != pkg.version:
-                        yield ValidationError('pkg_version', pkg_path,
-                            'Wrong PKG version ({} != {})'.format(
-                                entry['version'], pkg.version))
-                if checks['pkg_targets']:
-                    if entry['targets'] != pkg.targets:
-                        yield ValidationError('pkg_targets', pkg_path,
-                            'Wrong PKG targets ({} != {})'.format(
-                                entry['targets'], pkg.targets))
-                if checks['pkg_checksum']:
-                    if entry['checksum'] != pkg.checksum:
-                        yield ValidationError('pkg_checksum', pkg_path,
-                            'Wrong PKG checksum ({} != {})'.format(
-                                entry['checksum'], pkg.checksum))
-            except CalledProcessError:
-                pass
-
-        if checks['loads_has_codec'] and not codecs:
-            yield ValidationError('loads_has_codec', loads_path,
-                'No codec targets found in .loads file')
-        if checks['loads_filename'] and codecs:
-            if len(codecs) == 1:  # .loads file targets a single codec
-                target, path, version = codecs[0]
-                pref_name = preferred_pkg_filename(target, version, '.loads')
-            else:  # .loads file targets multiple codecs
-                raise NotImplementedError('What is the preferred filename for a super-loads?')
-            if loads_path.name != pref_name:
-                yield ValidationError('loads_filename', loads_path,
-                    '{} is not the preferred filename ({})'.format(
-                        loads_path.name, pref_name))
-        if checks['pkg_filename'] and codecs:
-            expect_version = codecs[0][2]  # all .pkgs should use same version
-            for target, pkg_filename, *_ in codecs + peripherals:
-                pref_name = preferred_pkg_filename(target, expect_version)
-                if pkg_filename != pref_name:
-                    yield ValidationError('pkg_filename', loads_path,
-                        '{} is not the preferred filename ({})'.format(
-                            pkg_filename, pref_name))
-
-        if checks['loads_signed']:
             sgn_path = loads_path.with_suffix('.loads.sgn')
-            if not sgn_path.is_file():
-                yield ValidationError('loads_signed', loads_path,
-                    '{} is missing'.format(sgn_path))
-            if ticket is None:
-                good = loadssign.test_verify(loads_path, sgn_path)
+            inputs = [index.fingerprint(p)
+                      for p in [loads_path, sgn_path] + pkg_paths]
+            cached = state.lookup(loads_path, inputs)
+            if cached is not None:
+                logger.info('Unchanged since last validation: {}'.format(
+                    loads_path))
+                yield from cached
             else:
-                good = loadssign.release_verify(loads_path, sgn_path, ticket)
-            if not good:
-                yield ValidationError('loads_signed', loads_path,
-                    '{} is not a valid {} signature'.format(
-                        sgn_path, 'release' if ticket else 'test'))
+                pending.append((loads_path, loads, inputs))
+                errors[loads_path] = []
+
+        pkg_refs = []  # (loads_path, entry, pkg_path, resolved) for PKG checks
+        for loads_path, loads, _ in pending:
+            for error in _check_structure(
+                    loadsdir, loads_path, loads, checks, pkg_refs, index):
+                errors[loads_path].append(error)
+                yield error
+
+        if checks['loads_signed'] and pending:
+            for loads_path, error in _check_signatures(
+                    [loads_path for loads_path, _, _ in pending], ticket,
+                    index):
+                errors[loads_path].append(error)
+                yield error
+
+        for loads_path, error in _check_pkgs(pkg_refs, checks, index):
+            errors[loads_path].append(error)
+            yield error
+
+        for loads_path, _, inputs in pending:
+            state.store(loads_path, inputs, errors[loads_path])
+    finally:
+        state.save()
 
     if checks['pkg_attached']:
-        for pkg in loadsdir.rglob('*.pkg'):
-            if pkg.resolve() not in seen_pkgs:
+        for pkg in index.find('.pkg'):
+            if index.resolve(pkg) not in seen_pkgs:
                 yield ValidationError('pkg_attached', pkg,
                     'Not referenced from any .loads file')
 
 
+def _check_structure(loadsdir, loads_path, loads, checks, pkg_refs, index):
+    '''Perform the cheap validate() checks for a single .loads file.
+
+    These checks only look at the .loads file itself and the filesystem
+    layout around it (as recorded in the given FsIndex). Entries whose PKGs
+    should be inspected by _check_pkgs() are appended to 'pkg_refs'.
+    '''
+    # Reverse-map product names into targets
+    Products = {t.product: t for t in loadsfile.Targets.values()}
+
+    codecs, peripherals = [], []
+    for entry in loads:
+        pkg_ref = Path(entry['packageLocation'])
+
+        if checks['pkg_relative']:
+            if pkg_ref.is_absolute() or '://' in str(pkg_ref):
+                yield ValidationError('pkg_relative', loads_path,
+                    '{} is absolute filename or URL'.format(pkg_ref))
+        pkg_path = loads_path.parent / pkg_ref
+        if checks['pkg_inside']:
+            if loadsdir not in pkg_path.parents:
+                yield ValidationError('pkg_inside', loads_path,
+                    '{} is not within {}'.format(pkg_path, loadsdir))
+        pkg_exists = index.is_file(pkg_path)
+        if checks['pkg_exists']:
+            if not pkg_exists:
+                yield ValidationError('pkg_exists', loads_path,
+                    '{} does not exist as a file'.format(pkg_path))
+        if checks['pkg_external_symlinks']:
+            if index.resolve(loadsdir) not in index.resolve(pkg_path).parents:
+                yield ValidationError('pkg_external_symlinks', loads_path,
+                    '{} points outside {}'.format(pkg_path, loadsdir))
+
+        try:
+            target = Products[entry['product']]
+        except KeyError:
+            if checks['product_exists']:
+                yield ValidationError('product_exists', loads_path,
+                    '{} is not a product name'.format(entry['product']))
+            continue
+
+        if target.is_codec:
+            codecs.append((target, pkg_path.name, entry['version']))
+        else:
+            peripherals.append((target, pkg_path.name))
+
+        if pkg_exists:
+            pkg_refs.append(
+                (loads_path, entry, pkg_path, index.resolve(pkg_path)))
+
+    if checks['loads_has_codec'] and not codecs:
+        yield ValidationError('loads_has_codec', loads_path,
+            'No codec targets found in .loads file')
+    if checks['loads_filename'] and codecs:
+        pref_name = preferred_loads_filename(
+            [target for target, *_ in codecs], codecs[0][2])
+        if loads_path.name != pref_name:
+            yield ValidationError('loads_filename', loads_path,
+                '{} is not the preferred filename ({})'.format(
+                    loads_path.name, pref_name))
+    if checks['pkg_filename'] and codecs:
+        expect_version = codecs[0][2]  # all .pkgs should use same version
+        for target, pkg_filename, *_ in codecs + peripherals:
+            pref_name = preferred_pkg_filename(target, expect_version)
+            if pkg_filename != pref_name:
+                yield ValidationError('pkg_filename', loads_path,
+                    '{} is not the preferred filename ({})'.format(
+                        pkg_filename, pref_name))
+
+
+def _check_signatures(loads_paths, ticket, index):
+    '''Verify the .loads.sgn signature for each of the given .loads files.
+
+    The public key is only retrieved once. Yield (loads_path, error) tuples.
+    '''
+    if ticket is None:
+        pubkey = loadssign.pubkey_from_cert()
+    else:
+        pubkey = loadssign.pubkey_from_swims_ticket(ticket)
+
+    for loads_path in loads_paths:
+        sgn_path = loads_path.with_suffix('.loads.sgn')
+        if not index.is_file(sgn_path):
+            yield loads_path, ValidationError('loads_signed', loads_path,
+                '{} is missing'.format(sgn_path))
+        elif not loadssign.verify(
+                index.local(loads_path), index.local(sgn_path), pubkey):
+            yield loads_path, ValidationError('loads_signed', loads_path,
+                '{} is not a valid {} signature'.format(
+                    sgn_path, 'release' if ticket else 'test'))
+
+
+def _check_pkgs(pkg_refs, checks, index):
+    '''Verify .loads entries against the actual PKGs they reference.
+
+    Each unique PKG is only inspected once, no matter how many entries (in how
+    many .loads files) refer to it. The checks that only need the PKG header
+    (pkg_version, pkg_targets) are done for all PKGs before the pkg_checksum
+    check, which needs to read each PKG in its entirety.
+    Yield (loads_path, error) tuples.
+    '''
+    probed = {}  # (resolved PKG path, attribute) -> value or None on failure
+
+    def probe(real_path, attr):
+        key = (real_path, attr)
+        if key not in probed:
+            try:
+                probed[key] = getattr(index.pkg_file(real_path), attr)
+            except subprocess.CalledProcessError:
+                probed[key] = None
+        return probed[key]
+
+    for check, field in [('pkg_version', 'version'),
+                         ('pkg_targets', 'targets'),
+                         ('pkg_checksum', 'checksum')]:
+        if not checks[check]:
+            continue
+        for loads_path, entry, pkg_path, real_path in pkg_refs:
+            actual = probe(real_path, field)
+            if actual is not None and entry[field] != actual:
+                yield loads_path, ValidationError(check, pkg_path,
+                    'Wrong PKG {} ({} != {})'.format(
+                        field, entry[field], actual))
+
+
 def main():
     import argparse
 
@@ -439,9 +1548,18 @@ def main():
     parser.add_argument(
         '--copy', dest='symlink', action='store_false',
         help='Copy PKG files into loads dir (instead of symlinking)')
+    parser.add_argument(
+        '--store', type=Path, default=None,
+        help='Hardlink/reflink PKG files into loads dir from this '
+             'content-addressed PKG store (instead of symlinking/copying)')
+    parser.add_argument(
+        '--gc', action='store_true',
+        help='Remove PKGs from --store that are not referenced from any '
+             '.loads file within the destination directory')
     parser.add_argument(
         '--deps', '-d', action='store_true',
-        help='Automatically include dependencies of the given target')
+        help='Automatically include dependencies of the given target (or '
+             'of several codec targets, to build a super-loads)')
     parser.add_argument(
         '--objdir', '-O', default=None,
         help='Look here for dependents\' build output (default: _build)')
@@ -451,24 +1569,66 @@ def main():
     parser.add_argument(
         '--ticket', type=Path, default=None,
         help='Use this SWIMS ticket to verify .loads signatures.')
+    parser.add_argument(
+        '--state', type=Path, default=None,
+        help='Keep validation results in this file, and only revalidate '
+             '.loads files whose inputs have changed since the last run.')
+    parser.add_argument(
+        '--export', type=Path, metavar='OUT.tar[.zst]', default=None,
+        help='Write loads dir (.loads, .sgn and PKG files) into this tar '
+             'archive (zstd-compressed if named *.zst), with a SHA512SUMS '
+             'manifest.')
     parser.add_argument(
         '--serve', action='store_true',
-        help='Serve loads dir over HTTP until you press Ctrl+C.')
+        help='Serve loads dir over HTTP until you press Ctrl+C. The loads '
+             'dir may also be an uncompressed tar archive (see --export), '
+             'which is served without extracting it. Likewise for --validate.')
+    parser.add_argument(
+        '--mirror', metavar='URL', default=None,
+        help='With --serve: Act as a caching proxy for the loads dirs at this '
+             'upstream URL, caching them within the destination directory.')
+    parser.add_argument(
+        '--cache-size', type=float, default=50,
+        help='With --mirror: Max GiB of PKGs to keep cached (default: 50)')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='Keep a loads dir (with deps) for each given target within the '
+             'destination, and rebuild them when PKGs change, until you '
+             'press Ctrl+C.')
+    parser.add_argument(
+        '--settle', type=float, default=2.0,
+        help='With --watch: Seconds a PKG must be unchanged before being used')
 
     args = parser.parse_args()
 
     args.target = [loadsfile.Targets[name] for name in args.target]
 
+    if args.watch:
+        if not args.target or args.file:
+            parser.error('--watch needs --target(s), but no --file options!')
+        args.destination.mkdir(parents=True, exist_ok=True)
+        try:
+            watch(args.destination, args.target, objdir=args.objdir,
+                  settle=args.settle, symlink=args.symlink, store=args.store)
+        except KeyboardInterrupt:
+            print('Stopped by user!')
+        return 0
+
     if args.deps:
-        assert len(args.target) == 1
-        assert len(args.file) <= 1
+        assert args.target
+        assert len(args.target) == 1 or all(t.is_codec for t in args.target)
+        assert not args.file or len(args.file) == len(args.target)
 
-        args.target, args.file = zip(*verify_pkgs(find_target_deps_and_pkgs(
-            args.target[0], args.file[0] if args.file else None, args.objdir)))
+        args.target, args.file = zip(*verify_pkgs(find_targets_deps_and_pkgs(
+            args.target, args.file or None, args.objdir)))
 
     if args.target and len(args.target) != len(args.file):
         parser.error(
             'Must specify pairs of corresponding --target and --file options!')
+    if args.gc and args.store is None:
+        parser.error('Must specify --store for --gc!')
+    if args.mirror and not args.serve:
+        parser.error('Must specify --serve for --mirror!')
 
     if args.target:
         print(build(
@@ -477,13 +1637,20 @@ def main():
             pkgs=args.file,
             version=args.version,
             loads_fname=args.loads_name,
-            symlink=args.symlink))
+            symlink=args.symlink,
+            store=args.store))
+
+    if args.gc:
+        removed = list(gc(args.store, [args.destination]))
+        print('Removed {} unreferenced PKGs from {}'.format(
+            len(removed), args.store))
 
     if args.validate:
         errors = 0
         for error in validate(
             args.destination,
             ticket=args.ticket,
+            state=args.state,
             pkg_external_symlinks=not args.symlink,
         ):
             logger.error(error)
@@ -492,8 +1659,28 @@ def main():
             print('{} validation errors found!'.format(errors))
             return errors
 
-    if args.serve:
-        loads_paths = sorted(p for p, f in walk(args.destination))
+    if args.export:
+        try:
+            manifest = export(args.destination, args.export)
+        except ValueError as e:
+            logger.error(e)
+            return 1
+        print('Exported {} files from {} into {}'.format(
+            len(manifest), args.destination, args.export))
+
+    if args.serve and args.mirror:
+        args.destination.mkdir(parents=True, exist_ok=True)
+        mirror = Mirror(args.destination, args.mirror,
+                        int(args.cache_size * 1024 * 1024 * 1024))
+        httpd = http_server(args.destination, mirror=mirror)
+        prefix = 'http://{}:{}/'.format(
+            loadsutil.guess_my_ip(), httpd.server_address[1])
+        print()
+        print('Mirroring {} at {}'.format(mirror.upstream, prefix))
+        print()
+    elif args.serve:
+        loads_paths = sorted(p for p, f in walk(
+            args.destination, open_index(args.destination)))
         assert loads_paths
         httpd = http_server(args.destination)
         print()
@@ -504,6 +1691,9 @@ def main():
         for path in loads_paths:
             print(prefix / path.relative_to(args.destination))
         print()
+
+    if args.serve:
+        print('Transfer metrics are available at {}metrics'.format(prefix))
         print('Press Ctrl+C to stop the server at any time.')
         try:
             httpd.serve_forever()
@@ -8,6 +8,7 @@ important part of how we distribute software upgrades for our products.
 See https://rdwiki.cisco.com/wiki/Swupgrade for more details.
 '''
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 import json
 import logging
@@ -15,7 +16,7 @@ from pathlib import Path
 import subprocess
 import sys
 
-from loadsutil import sha512sum
+from loadsutil import copy_and_sha512sum, copy_file, sha512sum
 
 
 logger = logging.getLogger('loadsfile')
@@ -77,12 +78,12 @@ Targets = {t[0]: Target(*t) for t in [
 class PkgFile:
     '''Cache some details about the PKG file at the given path.'''
 
-    def __init__(self, path):
+    def __init__(self, path, checksum=None):
         self.path = path
         assert path.is_file()
         self._targets = None
         self._version = None
-        self._checksum = None
+        self._checksum = checksum
 
     @property
     def targets(self):
@@ -110,6 +111,12 @@ class PkgFile:
             self._checksum = sha512sum(self.path)
         return self._checksum
 
+    def copy_to(self, dst):
+        '''Copy this PKG to 'dst', computing its checksum on the way.'''
+        checksum = copy_file(self.path, dst, checksum=self._checksum is None)
+        if checksum is not None:
+            self._checksum = checksum
+
 
 class PkgLoads:
     '''A .pkg.loads file already contains a JSON fragment for the .pkg.'''
@@ -131,6 +138,86 @@ class PkgLoads:
         for k in keys:
             setattr(self, k, fragment[0][k])
 
+    def copy_to(self, dst):
+        '''Copy this PKG to 'dst' (its checksum is already known).'''
+        copy_file(self.pkg_path, dst)
+
+
+def store_pkg_stream(target, stream, pkg_path):
+    '''Store the PKG read from 'stream' at 'pkg_path', and describe it.
+
+    The PKG is hashed while it is being written, and the version and targets
+    are extracted from its header afterwards. The result is also written to a
+    corresponding .pkg.loads file, so that pkg_info() takes its fast path for
+    this PKG, without reading it a second time. Return the PkgFile instance.
+    '''
+    with pkg_path.open('wb') as f:
+        checksum = copy_and_sha512sum(stream, f)
+    pkg = PkgFile(pkg_path, checksum)
+    write_pkg_loads(target, pkg)
+    return pkg
+
+
+def write_pkg_loads(target, pkg):
+    '''Write a .pkg.loads fragment describing the given PkgFile instance.
+
+    The fragment is written next to the PKG, and is atomically put in place.
+    '''
+    loads = LoadsFile()
+    loads.add_pkg(target, pkg, pkg.path.name)
+    loads_path = Path(str(pkg.path) + '.loads')
+    tmp = loads_path.with_name(loads_path.name + '.tmp')
+    with tmp.open('w') as f:
+        loads.write(f)
+    tmp.rename(loads_path)
+
+
+def refresh_pkg_loads(target, pkg_path):
+    '''Make sure the .pkg.loads fragment for the given PKG is up-to-date.
+
+    Return True if the fragment was (re)written, False if already current.
+    '''
+    try:
+        pkg = PkgLoads(pkg_path)
+        if pkg.product == target.product:
+            return False
+    except ValueError:
+        pass
+    write_pkg_loads(target, PkgFile(pkg_path))
+    return True
+
+
+def index(objdir=None, targets=None, jobs=None):
+    '''Pre-generate .pkg.loads fragments for all PKGs found in 'objdir'.
+
+    For each of the given 'targets' (default: all known Targets) that has a
+    PKG in 'objdir' (see loadsdir.find_pkg()), write its .pkg.loads fragment,
+    unless it is already up-to-date. This is done in parallel, by a pool of
+    'jobs' worker threads. Yield (target, pkg_path, status) for each target,
+    where status is one of 'written', 'current', 'missing' or 'failed'.
+    '''
+    import loadsdir  # avoid circular import
+
+    if targets is None:
+        targets = list(Targets.values())
+
+    def work(target):
+        try:
+            pkg_path = loadsdir.find_pkg(target.name, objdir)
+        except subprocess.CalledProcessError:
+            return target, None, 'missing'
+        if not pkg_path.is_file():
+            return target, pkg_path, 'missing'
+        try:
+            written = refresh_pkg_loads(target, pkg_path)
+        except subprocess.CalledProcessError as e:
+            logger.error('Failed to inspect {}: {}'.format(pkg_path, e))
+            return target, pkg_path, 'failed'
+        return target, pkg_path, 'written' if written else 'current'
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(work, targets)
+
 
 @lru_cache(maxsize=None)
 def pkg_info(target, pkg_path):
@@ -149,6 +236,12 @@ def pkg_info(target, pkg_path):
 class LoadsFile:
     @classmethod
     def parse(cls, path):
+        with path.open() as f:
+            return cls.load(f)
+
+    @classmethod
+    def load(cls, f):
+        '''Parse and validate a .loads file from the file object 'f'.'''
         def non_empty_str(s):
             return isinstance(s, str) and len(s) > 0
 
@@ -163,8 +256,7 @@ class LoadsFile:
             'checksum': non_empty_str,
         }
 
-        with path.open() as f:
-            loads = json.load(f)
+        loads = json.load(f)
         assert isinstance(loads, list)
         for entry in loads:
             assert isinstance(entry, dict)
@@ -181,6 +273,10 @@ class LoadsFile:
 
     def add(self, target, pkg_path, url):
         pkg = PkgFile(pkg_path) if self.verify else pkg_info(target, pkg_path)
+        self.add_pkg(target, pkg, url)
+
+    def add_pkg(self, target, pkg, url):
+        '''Add entry for an already inspected PkgFile/PkgLoads instance.'''
         self.loads.append({
             'product': target.product,
             'packageLocation': url,
@@ -218,14 +314,35 @@ def main():
         '--verify', action='store_true',
         help='Do not reuse existing .pkg.loads files.')
 
+    subcommands = parser.add_subparsers(dest='subcommand')
+
+    cmd_index = subcommands.add_parser(
+        'index', help='Write missing/outdated .pkg.loads files for all PKGs')
+    cmd_index.add_argument(
+        'objdir', nargs='?', default=None,
+        help='Look here for build output (default: _build)')
+    cmd_index.add_argument(
+        '--jobs', '-j', type=int, default=None,
+        help='Number of parallel workers (default: based on CPU count)')
+
     args = parser.parse_args()
-    if len(args.target) != len(args.file):
-        parser.error(
-            'Must specify pairs of corresponding --target and --file options!')
     if args.pkgextract:
         global PKGEXTRACT
         PKGEXTRACT = args.pkgextract
 
+    if args.subcommand == 'index':
+        failed = 0
+        for target, pkg_path, status in index(
+                args.objdir, [Targets[t] for t in args.target] or None,
+                args.jobs):
+            print('{:>16}: {:8} {}'.format(str(target), status, pkg_path))
+            failed += status == 'failed'
+        return 1 if failed else 0
+
+    if len(args.target) != len(args.file):
+        parser.error(
+            'Must specify pairs of corresponding --target and --file options!')
+
     # Disable .pkg.loads optimization when we're writing to a .pkg.loads file.
     if args.output.name.endswith('.pkg.loads'):
         args.verify = True
@@ -240,4 +357,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
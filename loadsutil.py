@@ -1,27 +1,130 @@
+import fcntl
 import hashlib
+import os
 from pathlib import Path
+import shutil
 import subprocess
 import socket
 import sys
+import time
 
 
 # Assume this file is located one level below main repo root ($MAIN/bin/util.py)
 MAIN_ROOT = Path(sys.modules[__name__].__file__).resolve().parent.parent
 
+READ_SIZE = 1024 * 1024  # 1MB blocks
+FICLONE = 0x40049409  # ioctl request number from <linux/fs.h>
 
-def sha512sum(path):
-    '''Return the SHA512 checksum of the file contents at the given path.'''
-    READ_SIZE = 1024 * 1024  # 1MB blocks
+
+def sha512sum(path, size=None, offset=0):
+    '''Return the SHA512 checksum of the file contents at the given path.
+
+    If 'size' is given, only the first 'size' bytes of the file are included.
+    If 'offset' is given, start hashing from that position within the file.
+    '''
     d = hashlib.sha512()
+    remaining = size
     with path.open('rb') as f:
-        while True:
-            chunk = f.read(READ_SIZE)
+        f.seek(offset)
+        while remaining is None or remaining > 0:
+            chunk = f.read(READ_SIZE if remaining is None
+                           else min(READ_SIZE, remaining))
             if not chunk:
                 break
             d.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return d.hexdigest()
+
+
+def copy_and_sha512sum(src, dst):
+    '''Copy all data from file object 'src' into file object 'dst'.
+
+    Return the SHA512 checksum of the copied data, which is computed from the
+    same buffers that are written to 'dst', i.e. without reading it again.
+    '''
+    d = hashlib.sha512()
+    while True:
+        chunk = src.read(READ_SIZE)
+        if not chunk:
+            break
+        d.update(chunk)
+        dst.write(chunk)
     return d.hexdigest()
 
 
+def copy_file(src, dst, *, checksum=False):
+    '''Copy the file contents at path 'src' to path 'dst'.
+
+    On filesystems that support it (e.g. btrfs, XFS), 'dst' is made a reflink
+    (i.e. a copy-on-write clone sharing data blocks with 'src'). Otherwise,
+    the data is copied within the kernel with copy_file_range(), unless we also
+    need a 'checksum': Then the data is copied in user space, and hashed from
+    the same buffers, so that 'src' is read only once.
+
+    If 'checksum' is set, return the SHA512 checksum of the copied data.
+    '''
+    with src.open('rb') as fsrc, dst.open('wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return sha512sum(src) if checksum else None
+        except OSError:  # reflinks not supported here
+            pass
+
+        if checksum:
+            return copy_and_sha512sum(fsrc, fdst)
+
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), READ_SIZE):
+                pass
+        except (AttributeError, OSError):  # copy_file_range() not available
+            fdst.seek(0)
+            fdst.truncate()
+            fsrc.seek(0)
+            shutil.copyfileobj(fsrc, fdst, READ_SIZE)
+
+
+def watch(paths, *, settle=2.0, interval=1.0):
+    '''Watch the given file paths, and return generator of changed path sets.
+
+    The files are polled with stat() every 'interval' seconds (this also works
+    on network filesystems, where inotify does not). A changed file is only
+    reported once it has stopped changing for 'settle' seconds, e.g. when the
+    build has finished writing it. Files that disappear are not reported until
+    they reappear. Changes are detected relative to the files as they are
+    when watch() is called (not when iteration starts), including changes
+    made while the caller is busy between iterations. The returned generator
+    never ends by itself.
+    '''
+    def fingerprint(path):
+        try:
+            st = path.stat()
+            return st.st_ino, st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    current = {path: fingerprint(path) for path in paths}
+    return _poll(current, fingerprint, settle, interval)
+
+
+def _poll(current, fingerprint, settle, interval):
+    changed = {}  # path -> time of last observed change
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        for path in current:
+            fp = fingerprint(path)
+            if fp != current[path]:
+                current[path] = fp
+                changed[path] = now
+        settled = {path for path, t in changed.items()
+                   if now - t >= settle and current[path] is not None}
+        for path in settled:
+            del changed[path]
+        if settled:
+            yield settled
+
+
 def ip_route(addr):
     '''Consult the local routing tables for how to contact the given 'addr'.
 
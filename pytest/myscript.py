@@ -2,13 +2,32 @@
 '''Calculate the square of a given number.'''
 
 import argparse
+import io
+from itertools import islice
 import sys
 
 
+CHUNK_SIZE = 64 * 1024  # numbers per chunk in batch()
+
+
 def calc(num, exp):
     return num ** exp
 
 
+def batch(infile, outfile, exp, chunk_size=CHUNK_SIZE):
+    '''Calculate results for the numbers (one per line) read from 'infile'.
+
+    Numbers are read and calculated in chunks of 'chunk_size', and the
+    results for each chunk are written to 'outfile' in one go.
+    '''
+    nums = (int(line) for line in infile if line.strip())
+    while True:
+        results = [calc(num, exp) for num in islice(nums, chunk_size)]
+        if not results:
+            break
+        outfile.write('\n'.join(map(str, results)) + '\n')
+
+
 def test_calc():
     vectors = [
         (0, 2, 0), (1, 2, 1), (2, 2, 4),
@@ -18,11 +37,29 @@ def test_calc():
         assert calc(num, exp) == expect
 
 
+def test_batch():
+    vectors = [
+        ('', 2, ''),
+        ('0\n1\n2\n', 2, '0\n1\n4\n'),
+        ('0\n1\n\n-2\n3\n', 3, '0\n1\n-8\n27\n'),
+        ('{}\n'.format(2 ** 64), 2, '{}\n'.format(2 ** 128)),
+    ]
+    for data, exp, expect in vectors:
+        for chunk_size in [1, 2, CHUNK_SIZE]:
+            out = io.StringIO()
+            batch(io.StringIO(data), out, exp, chunk_size)
+            assert out.getvalue() == expect
+
+
 def main():
     parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
     parser.add_argument(
-        'num', type=int,
+        'num', type=int, nargs='?',
         help='the number to be squared')
+    parser.add_argument(
+        '--batch', '-b', type=argparse.FileType('r'), metavar='INPUT',
+        help='calculate for each number (one per line) in INPUT ("-" for '
+             'stdin) instead')
     parser.add_argument(
         '--cube', '-3', action='store_true',
         help='calculate the cube (instead of square)')
@@ -31,8 +68,13 @@ def main():
         help='write result here (stdout by default)')
 
     args = parser.parse_args()
-    result = calc(args.num, 3 if args.cube else 2)
-    print(result, file=args.file)
+    if (args.num is None) == (args.batch is None):
+        parser.error('Must specify either <num> or --batch!')
+    exp = 3 if args.cube else 2
+    if args.batch:
+        batch(args.batch, args.file, exp)
+    else:
+        print(calc(args.num, exp), file=args.file)
 
 
 if __name__ == '__main__':
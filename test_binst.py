@@ -0,0 +1,44 @@
+'''Tests for binst.py startup cost.'''
+
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+
+BINST = str(Path(__file__).resolve().parent / 'binst.py')
+RUNS = 5  # take the best of this many runs, to filter out noise
+MARGIN = 0.15  # seconds that binst.py may spend on top of a bare interpreter
+
+
+def best_time(argv):
+    '''Return the fastest wall clock time of RUNS runs of 'argv'.'''
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_startup_imports():
+    '''Paths that transfer nothing must not wait for the heavy modules.'''
+    heavy = {'loadsdir', 'loadsfile', 'loadssign', 'http.server', 'sqlite3'}
+    for args in [['--list-targets'], ['nosuchtarget', 'host']]:
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', BINST] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        imported = {line.split('|')[-1].strip()
+                    for line in proc.stderr.splitlines()
+                    if line.startswith('import time:')}
+        assert 'argparse' in imported
+        assert not heavy & imported, args
+
+
+def test_startup_time():
+    '''--list-targets must take hardly longer than starting Python.'''
+    bare = best_time([sys.executable, '-c', 'pass'])
+    binst = best_time([sys.executable, BINST, '--list-targets'])
+    assert binst < bare + MARGIN, (binst, bare)
@@ -0,0 +1,130 @@
+'''Tests for loadsdir.py's HTTP serving.'''
+
+from collections import Counter
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+from socketserver import ThreadingTCPServer
+import tarfile
+import threading
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import loadsdir
+
+
+PKG_SIZE = 1000
+
+
+@contextmanager
+def serving(root, mirror=None):
+    '''Serve 'root' from a background thread, yield its base URL.'''
+    httpd = loadsdir.http_server(root, ('127.0.0.1', 0), ThreadingTCPServer,
+                                 mirror=mirror)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        thread.join()
+        httpd.server_close()
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    '''Upstream loads dir with two good PKGs, a corrupt and a stray one.'''
+    root = tmp_path / 'upstream'
+    (root / 'x').mkdir(parents=True)
+    entries = []
+    for name in ['a', 'b', 'bad', 'stray']:
+        data = name.encode() * (PKG_SIZE // len(name))
+        (root / 'x' / (name + '.pkg')).write_bytes(data)
+        if name == 'bad':
+            data = b'not ' + data  # upstream's PKG does not match this
+        if name != 'stray':
+            entries.append({
+                'product': 'x',
+                'packageLocation': name + '.pkg',
+                'version': '1.0',
+                'targets': ['x'],
+                'checksum': hashlib.sha512(data).hexdigest(),
+            })
+    (root / 'x' / 'x.loads').write_text(json.dumps(entries))
+    with serving(root) as url:
+        yield url
+
+
+@pytest.fixture
+def mirror(tmp_path, upstream, monkeypatch):
+    '''Yield (Mirror instance, its URL, Counter of upstream downloads).'''
+    cache = tmp_path / 'cache'
+    mirror = loadsdir.Mirror(cache, upstream, max_size=int(PKG_SIZE * 1.5))
+    downloads = Counter()
+    download = mirror._download
+
+    def counting_download(rel_path):
+        downloads[str(rel_path)] += 1
+        return download(rel_path)
+
+    monkeypatch.setattr(mirror, '_download', counting_download)
+    with serving(cache, mirror) as url:
+        urlopen(url + 'x/x.loads').close()
+        yield mirror, url, downloads
+
+
+def get(url):
+    with urlopen(url) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', ['bad', 'stray'])
+def test_mirror_refuses_unverified_pkgs(mirror, name):
+    mirror, url, _ = mirror
+    with pytest.raises(HTTPError) as e:
+        get(url + 'x/{}.pkg'.format(name))
+    assert e.value.code == 404
+    assert not (mirror.cache / 'x' / (name + '.pkg')).exists()
+
+
+def test_mirror_fetches_pkg_once(mirror):
+    mirror, url, downloads = mirror
+    assert get(url + 'x/a.pkg') == get(url + 'x/a.pkg')
+    assert downloads['x/a.pkg'] == 1
+    get(url + 'x/x.loads')
+    assert downloads['x/x.loads'] == 2  # .loads files are always refetched
+
+
+def test_mirror_evicts_least_recently_used(mirror):
+    mirror, url, downloads = mirror
+    get(url + 'x/a.pkg')
+    get(url + 'x/b.pkg')
+    cached = [p for p in (mirror.cache / 'x').iterdir() if p.suffix == '.pkg']
+    assert [p.name for p in cached] == ['b.pkg']
+    assert sum(p.stat().st_size for p in cached) <= mirror.max_size
+    get(url + 'x/a.pkg')  # evicted, so fetched again
+    assert downloads['x/a.pkg'] == 2
+
+
+def test_archive_head(tmp_path):
+    archive = tmp_path / 'loads.tar'
+    with tarfile.open(str(archive), 'w') as tar:
+        info = tarfile.TarInfo('x/a.pkg')
+        info.size = PKG_SIZE
+        tar.addfile(info, io.BytesIO(b'a' * PKG_SIZE))
+    with serving(archive) as url:
+        with urlopen(Request(url + 'x/a.pkg', method='HEAD')) as f:
+            assert f.status == 200
+            assert f.headers['Content-Length'] == str(PKG_SIZE)
+            assert f.read() == b''
+        req = Request(url + 'x/a.pkg', method='HEAD',
+                      headers={'Range': 'bytes=-10'})
+        with urlopen(req) as f:
+            assert f.status == 206
+            assert f.headers['Content-Length'] == '10'
+        with pytest.raises(HTTPError) as e:
+            urlopen(Request(url + 'x/nosuch.pkg', method='HEAD'))
+        assert e.value.code == 404
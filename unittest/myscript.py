@@ -2,19 +2,42 @@
 '''Calculate the square of a given number.'''
 
 import argparse
+import io
+from itertools import islice
 import sys
 import unittest
 
 
+CHUNK_SIZE = 64 * 1024  # numbers per chunk in batch()
+
+
 def calc(num, exp):
     return num ** exp
 
 
+def batch(infile, outfile, exp, chunk_size=CHUNK_SIZE):
+    '''Calculate results for the numbers (one per line) read from 'infile'.
+
+    Numbers are read and calculated in chunks of 'chunk_size', and the
+    results for each chunk are written to 'outfile' in one go.
+    '''
+    nums = (int(line) for line in infile if line.strip())
+    while True:
+        results = [calc(num, exp) for num in islice(nums, chunk_size)]
+        if not results:
+            break
+        outfile.write('\n'.join(map(str, results)) + '\n')
+
+
 def main():
     parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
     parser.add_argument(
-        'num', type=int,
+        'num', type=int, nargs='?',
         help='the number to be squared')
+    parser.add_argument(
+        '--batch', '-b', type=argparse.FileType('r'), metavar='INPUT',
+        help='calculate for each number (one per line) in INPUT ("-" for '
+             'stdin) instead')
     parser.add_argument(
         '--cube', '-3', action='store_true',
         help='calculate the cube (instead of square)')
@@ -23,8 +46,13 @@ def main():
         help='write result here (stdout by default)')
 
     args = parser.parse_args()
-    result = calc(args.num, 3 if args.cube else 2)
-    print(result, file=args.file)
+    if (args.num is None) == (args.batch is None):
+        parser.error('Must specify either <num> or --batch!')
+    exp = 3 if args.cube else 2
+    if args.batch:
+        batch(args.batch, args.file, exp)
+    else:
+        print(calc(args.num, exp), file=args.file)
 
 
 if __name__ == '__main__':
@@ -53,3 +81,28 @@ class TestCube(unittest.TestCase):
 
     def test_two_cubed_is_eight(self):
         self.assertEqual(8, calc(2, 3))
+
+
+class TestBatch(unittest.TestCase):
+
+    def batch(self, data, exp, chunk_size=CHUNK_SIZE):
+        out = io.StringIO()
+        batch(io.StringIO(data), out, exp, chunk_size)
+        return out.getvalue()
+
+    def test_empty_input_gives_empty_output(self):
+        self.assertEqual('', self.batch('', 2))
+
+    def test_one_result_per_line(self):
+        self.assertEqual('0\n1\n4\n', self.batch('0\n1\n2\n', 2))
+
+    def test_blank_lines_are_skipped(self):
+        self.assertEqual('0\n-8\n27\n', self.batch('0\n\n-2\n3\n', 3))
+
+    def test_chunks_give_same_output(self):
+        data = ''.join('{}\n'.format(i) for i in range(10))
+        self.assertEqual(self.batch(data, 2), self.batch(data, 2, 3))
+
+    def test_big_numbers_are_exact(self):
+        self.assertEqual(
+            '{}\n'.format(2 ** 192), self.batch('{}\n'.format(2 ** 64), 3))